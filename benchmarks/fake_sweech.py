@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+"""A local stand-in for the Sweech Android app HTTP server.
+
+It serves a local directory through the same HTTP API as the app, so that
+`sweech.Connector` can be exercised and benchmarked without a phone.
+Remote absolute paths are mapped below the served root directory.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+# == Helpers ==================================================================
+
+
+class _Throttle(object):
+    """Limits the throughput of a single response or request body"""
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._start = time.monotonic()
+        self._count = 0
+
+    def __call__(self, nbytes):
+        if not self._rate:
+            return
+        self._count += nbytes
+        delay = self._count / float(self._rate) - (time.monotonic() - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _parse_auth_header(value):
+    fields = {}
+    for part in value[len('Digest '):].split(','):
+        key, _, val = part.strip().partition('=')
+        fields[key] = val.strip('"')
+    return fields
+
+
+def _md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+# == Server ===================================================================
+
+
+class FakeSweechServer(ThreadingHTTPServer):
+    """HTTP server emulating the Sweech API on top of a local directory
+
+    Args:
+        address (tuple): (host, port) to listen on, port 0 picks a free port
+        root (str): local directory exposed as the device filesystem
+        user (str, optional): enables digest authentication with this username
+        password (str, optional): the digest authentication password
+        latency (float): seconds added before each response
+        bandwidth (int): maximum bytes per second for each transfer, 0 for unlimited
+        ranges (bool): whether `Range` headers are honoured by `/api/fs`
+        nonce_lifetime (float): seconds after which a digest nonce becomes stale
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Many concurrent clients may connect at once
+    request_queue_size = 128
+
+    def __init__(self, address, root, user = None, password = None, latency = 0.0, bandwidth = 0,
+                 ranges = True, nonce_lifetime = 300.0):
+        ThreadingHTTPServer.__init__(self, address, _Handler)
+        self.root = os.path.abspath(root)
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.nonce_lifetime = nonce_lifetime
+        self.clipboard = ''
+        self.lock = threading.Lock()
+        self.nonces = {}
+        self.counters = {}
+        self.connections = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.counters = {}
+            self.connections = 0
+
+    def local_path(self, path):
+        path = os.path.normpath('/' + path.lstrip('/'))
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def new_nonce(self):
+        nonce = hashlib.md5(os.urandom(16)).hexdigest()
+        with self.lock:
+            self.nonces[nonce] = time.monotonic()
+        return nonce
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections before the end of a response are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and bodies are written separately, don't let them wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    # == Plumbing =============================================================
+
+    def _send(self, code, body = b'', content_type = 'application/octet-stream', headers = {}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        throttle = _Throttle(self.server.bandwidth)
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, 64 * 1024))
+            if not chunk:
+                break
+            throttle(len(chunk))
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def _check_auth(self):
+        server = self.server
+        if server.user is None:
+            return True
+        header = self.headers.get('Authorization')
+        stale = False
+        if header is not None and header.startswith('Digest '):
+            fields = _parse_auth_header(header)
+            nonce = fields.get('nonce')
+            with server.lock:
+                issued = server.nonces.get(nonce)
+            ha1 = _md5('{}:Sweech:{}'.format(server.user, server.password))
+            ha2 = _md5('{}:{}'.format(self.command, fields.get('uri', '')))
+            if fields.get('qop'):
+                expected = _md5(':'.join([ha1, nonce, fields.get('nc', ''), fields.get('cnonce', ''), fields['qop'], ha2]))
+            else:
+                expected = _md5(':'.join([ha1, nonce, ha2]))
+            if fields.get('username') == server.user and fields.get('response') == expected:
+                if issued is not None and time.monotonic() - issued < server.nonce_lifetime:
+                    return True
+                stale = True
+        server.count('401')
+        challenge = 'Digest realm="Sweech", qop="auth", nonce="{}", opaque="0123456789"'.format(server.new_nonce())
+        if stale:
+            challenge += ', stale=true'
+        self._read_body()
+        self._send(401, b'Unauthorized', 'text/plain', { 'WWW-Authenticate': challenge })
+        return False
+
+    def _dispatch(self):
+        server = self.server
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency)
+        if not self._check_auth():
+            return
+        path = unquote(self.path.split('?', 1)[0])
+        for prefix in ('/api/ls', '/api/fs', '/api/fileops/', '/api/info', '/api/clipboard'):
+            if path.startswith(prefix):
+                server.count(prefix)
+                try:
+                    getattr(self, '_' + prefix.strip('/').replace('/', '_'))(path[len(prefix):])
+                except ConnectionError:
+                    raise
+                except (IOError, OSError):
+                    self._send(404, b'Not found', 'text/plain')
+                return
+        self._send(404, b'Not found', 'text/plain')
+
+    do_GET = _dispatch
+    do_POST = _dispatch
+
+    # == API ==================================================================
+
+    def _item(self, local_path):
+        st = os.stat(local_path)
+        is_dir = os.path.isdir(local_path)
+        return {
+            'name': os.path.basename(local_path),
+            'isDir': is_dir,
+            'isReadable': True,
+            'isWritable': True,
+            'size': len(os.listdir(local_path)) if is_dir else st.st_size,
+            'lastModified': int(st.st_mtime * 1000),
+        }
+
+    def _api_info(self, path):
+        self._send_json({
+            'brand': 'Fake',
+            'model': 'Sweech',
+            'sdk': 30,
+            'storagePaths': {
+                'internal': { 'path': '/storage/emulated/0', 'name': None, 'availableBytes': 1 << 34, 'totalBytes': 1 << 35 },
+                'externals': [],
+            },
+            'directories': {
+                'download': { 'path': '/storage/emulated/0/Download', 'exists': True },
+            },
+        })
+
+    def _api_ls(self, path):
+        local_path = self.server.local_path(path)
+        response = self._item(local_path)
+        if response['isDir']:
+            response['content'] = [ self._item(os.path.join(local_path, name)) for name in sorted(os.listdir(local_path)) ]
+        self._send_json(response)
+
+    def _api_fs(self, path):
+        local_path = self.server.local_path(path)
+        if self.command == 'POST':
+            os.makedirs(os.path.dirname(local_path), exist_ok = True)
+            data = self._read_body()
+            with open(local_path, 'wb') as f:
+                f.write(data)
+            self._send(200)
+            return
+        size = os.path.getsize(local_path)
+        start, end = 0, size - 1
+        code = 200
+        headers = {}
+        range_header = self.headers.get('Range')
+        if self.server.ranges and range_header and range_header.startswith('bytes=') and size > 0:
+            first, _, last = range_header[len('bytes='):].partition('-')
+            if first == '':
+                start = max(0, size - int(last))
+            else:
+                start = int(first)
+                if last != '':
+                    end = min(int(last), size - 1)
+            if start >= size:
+                self._send(416, b'', 'text/plain', { 'Content-Range': 'bytes */{}'.format(size) })
+                return
+            code = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        length = max(0, end - start + 1)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        throttle = _Throttle(self.server.bandwidth)
+        with open(local_path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(length, 64 * 1024))
+                if not chunk:
+                    break
+                throttle(len(chunk))
+                self.wfile.write(chunk)
+                length -= len(chunk)
+
+    def _api_fileops(self, op):
+        request = json.loads(self._read_body().decode('utf-8'))
+        server = self.server
+        if op == 'mkdir':
+            os.makedirs(server.local_path(request['dir']), exist_ok = True)
+        elif op == 'delete':
+            for item in request['items']:
+                local_path = server.local_path(request['baseDir'] + '/' + item)
+                if os.path.isdir(local_path):
+                    shutil.rmtree(local_path)
+                else:
+                    os.remove(local_path)
+        elif op == 'move':
+            src = server.local_path(request['src'])
+            dst = server.local_path(request['dst'])
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            shutil.move(src, dst)
+        else:
+            self._send(404, b'Not found', 'text/plain')
+            return
+        self._send(200)
+
+    def _api_clipboard(self, path):
+        if self.command == 'POST':
+            self.server.clipboard = json.loads(self._read_body().decode('utf-8'))['content']
+            self._send(200)
+        else:
+            self._send_json({ 'content': self.server.clipboard })
+
+
+# == Main =====================================================================
+
+
+def _main():
+    parser = argparse.ArgumentParser(description = 'Serve a local directory through the Sweech HTTP API')
+    parser.add_argument('root', help = 'Directory exposed as the device filesystem')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'Address to listen on')
+    parser.add_argument('--port', type = int, default = 4444, help = 'Port to listen on')
+    parser.add_argument('--user', help = 'Enables digest authentication with this username')
+    parser.add_argument('--password', default = '', help = 'Digest authentication password')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'Seconds added before each response')
+    parser.add_argument('--bandwidth', type = int, default = 0, help = 'Bytes per second limit for each transfer')
+    parser.add_argument('--no-ranges', dest = 'ranges', action = 'store_false', help = 'Ignore Range headers')
+    args = parser.parse_args()
+
+    server = FakeSweechServer((args.host, args.port), args.root, args.user, args.password,
+                              args.latency, args.bandwidth, args.ranges)
+    sys.stderr.write('Serving {} on {}\n'.format(server.root, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    _main()
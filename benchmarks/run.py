@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""Benchmarks `sweech.Connector` against a local fake Sweech server.
+
+Synthetic trees are generated in a temporary directory, served by
+`fake_sweech.FakeSweechServer`, and `pull`, `push`, `ls` and `cat` are timed
+on each of them. The startup time of the `sweech` command line is measured
+too, and checked against a target. Results can be saved and compared to a
+previous run to catch performance regressions:
+
+    $ python benchmarks/run.py --save baseline.json
+    $ python benchmarks/run.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ _HERE, os.path.dirname(_HERE) ]
+
+import sweech
+from fake_sweech import FakeSweechServer
+
+
+_REMOTE_ROOT = '/storage/emulated/0/bench'
+
+
+# == Synthetic trees ==========================================================
+
+
+def _write_file(path, size):
+    with open(path, 'wb') as f:
+        block = os.urandom(min(size, 1024 * 1024))
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def _make_tiny(root, scale):
+    """Many tiny files spread over a few directories"""
+    for i in range(10):
+        directory = os.path.join(root, 'dir{:02}'.format(i))
+        os.makedirs(directory)
+        for j in range(50 * scale):
+            _write_file(os.path.join(directory, 'file{:04}.txt'.format(j)), 1024)
+
+
+def _make_huge(root, scale):
+    """A few huge files"""
+    os.makedirs(root)
+    for i in range(3):
+        _write_file(os.path.join(root, 'huge{}.bin'.format(i)), 16 * 1024 * 1024 * scale)
+
+
+def _make_deep(root, scale):
+    """Deeply nested directories with a couple of files on each level"""
+    directory = root
+    for i in range(16 * scale):
+        directory = os.path.join(directory, 'level{:02}'.format(i))
+        os.makedirs(directory)
+        for j in range(2):
+            _write_file(os.path.join(directory, 'file{}.dat'.format(j)), 16 * 1024)
+
+
+_TREES = [ ('tiny', _make_tiny), ('huge', _make_huge), ('deep', _make_deep) ]
+
+
+def _tree_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, root).replace(os.sep, '/'), os.path.getsize(path)
+
+
+def _tree_dirs(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        yield os.path.relpath(dirpath, root).replace(os.sep, '/')
+
+
+# == Scenarios ================================================================
+
+
+def _bench_pull(connector, tree, local_root, scratch, jobs):
+    destination = os.path.join(scratch, 'pull')
+    os.makedirs(destination)
+    connector.pull(_REMOTE_ROOT + '/' + tree, destination, keep = False, jobs = jobs)
+    return sum(size for _, size in _tree_files(local_root))
+
+
+def _bench_push(connector, tree, local_root, scratch, jobs):
+    destination = _REMOTE_ROOT + '/pushed-' + tree
+    try:
+        connector.push(local_root, destination, keep = False, jobs = jobs)
+    finally:
+        connector.rm(destination)
+    return sum(size for _, size in _tree_files(local_root))
+
+
+def _bench_ls(connector, tree, local_root, scratch, jobs):
+    for relpath in _tree_dirs(local_root):
+        connector.ls(_REMOTE_ROOT + '/' + tree + ('' if relpath == '.' else '/' + relpath))
+    return 0
+
+
+def _bench_walk(connector, tree, local_root, scratch, jobs):
+    for dirpath, items in connector.walk(_REMOTE_ROOT + '/' + tree, jobs):
+        pass
+    return 0
+
+
+def _bench_cat(connector, tree, local_root, scratch, jobs):
+    total = 0
+    for relpath, size in _tree_files(local_root):
+        with open(os.devnull, 'wb') as f:
+            connector.download(_REMOTE_ROOT + '/' + tree + '/' + relpath, f)
+        total += size
+    return total
+
+
+_SCENARIOS = [ ('pull', _bench_pull), ('push', _bench_push), ('ls', _bench_ls), ('walk', _bench_walk),
+               ('cat', _bench_cat) ]
+
+
+_STARTUP_COMMANDS = [ ('help', [ '--help' ]), ('info', [ 'info' ]), ('ls', [ 'ls', _REMOTE_ROOT ]) ]
+
+
+def _bench_startup(server, args):
+    """Times whole `sweech` runs in new interpreters, the way the installed `sweech` script starts"""
+    env = dict(os.environ, PYTHONPATH = os.path.dirname(_HERE))
+
+    def best_time(command):
+        best = None
+        for _ in range(args.repeat * 5):
+            start = time.perf_counter()
+            subprocess.check_call([ sys.executable ] + command, stdout = subprocess.DEVNULL, env = env)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    connection = [ '-u', server.url ]
+    if args.user:
+        connection += [ '--user', args.user, '--password', args.password ]
+    interpreter = best_time([ '-c', 'pass' ])
+    results = {}
+    for name, command in _STARTUP_COMMANDS:
+        seconds = best_time([ '-c', 'import sweech; sweech._main()' ] + connection + command)
+        key = 'startup/' + name
+        results[key] = { 'seconds': seconds, 'overhead': seconds - interpreter }
+        print('{:<12} {:>9.3f}s {:>+9.3f}s over the interpreter startup'.format(key, seconds, seconds - interpreter))
+        sys.stdout.flush()
+    return results
+
+
+# == Runner ===================================================================
+
+
+def _run(args):
+    workdir = tempfile.mkdtemp(prefix = 'sweech-bench-')
+    try:
+        device_root = os.path.join(workdir, 'device')
+        local_base = os.path.join(device_root, _REMOTE_ROOT.lstrip('/'))
+        os.makedirs(local_base)
+        scenarios = [ (name, function) for name, function in _SCENARIOS if not args.scenario or name in args.scenario ]
+        trees = [ name for name, _ in _TREES if scenarios and (not args.tree or name in args.tree) ]
+        for name, make_tree in _TREES:
+            if name in trees:
+                make_tree(os.path.join(local_base, name), args.scale)
+
+        server = FakeSweechServer(('127.0.0.1', 0), device_root, args.user, args.password,
+                                  args.latency, args.bandwidth).start()
+        results = {}
+        try:
+            if not args.scenario or 'startup' in args.scenario:
+                results.update(_bench_startup(server, args))
+            for tree in trees:
+                for scenario, function in scenarios:
+                    best = None
+                    for _ in range(args.repeat):
+                        scratch = os.path.join(workdir, 'scratch')
+                        os.makedirs(scratch)
+                        with sweech.Connector(server.url, args.user, args.password, rate_limit = args.limit_rate,
+                                              adaptive = args.adaptive) as connector:
+                            server.reset_counters()
+                            start = time.perf_counter()
+                            nbytes = function(connector, tree, os.path.join(local_base, tree), scratch, args.jobs)
+                            elapsed = time.perf_counter() - start
+                        shutil.rmtree(scratch)
+                        if best is None or elapsed < best['seconds']:
+                            best = {
+                                'seconds': elapsed,
+                                'bytes': nbytes,
+                                'requests': server.counters.get('requests', 0),
+                                'connections': server.connections,
+                            }
+                    best['throughput'] = best['bytes'] / best['seconds']
+                    best['requests_per_second'] = best['requests'] / best['seconds']
+                    key = '{}/{}'.format(tree, scenario)
+                    results[key] = best
+                    _print_result(key, best)
+        finally:
+            server.stop()
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _print_result(key, result):
+    print('{:<12} {:>9.3f}s {:>10}/s {:>9.1f} req/s {:>6} requests {:>4} connections'.format(
+        key, result['seconds'], sweech._pretty_size(int(result['throughput'])).strip(),
+        result['requests_per_second'], result['requests'], result['connections']))
+    sys.stdout.flush()
+
+
+def _compare(results, baseline, tolerance, min_delta):
+    regressions = []
+    for key, result in sorted(results.items()):
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        ratio = result['seconds'] / reference['seconds']
+        if ratio > 1.0 + tolerance and result['seconds'] - reference['seconds'] > min_delta:
+            regressions.append('{}: {:.3f}s instead of {:.3f}s ({:+.0f}%)'.format(
+                key, result['seconds'], reference['seconds'], (ratio - 1.0) * 100))
+    return regressions
+
+
+# == Main =====================================================================
+
+
+def _main():
+    parser = argparse.ArgumentParser(description = 'Benchmark sweech against a local fake Sweech server')
+    parser.add_argument('--tree', action = 'append', choices = [ name for name, _ in _TREES ],
+                        help = 'Synthetic tree to benchmark (may be repeated, all by default)')
+    parser.add_argument('--scenario', action = 'append', choices = [ name for name, _ in _SCENARIOS ] + [ 'startup' ],
+                        help = 'Operation to benchmark (may be repeated, all by default)')
+    parser.add_argument('--scale', type = int, default = 1, help = 'Multiplies the size of the synthetic trees')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Runs per scenario, the best one is reported')
+    parser.add_argument('-j', '--jobs', type = int, default = 4, help = 'Concurrent requests for pull, push and walk')
+    parser.add_argument('--latency', type = float, default = 0.005, help = 'Seconds added before each response')
+    parser.add_argument('--bandwidth', type = int, default = 0, help = 'Bytes per second limit for each transfer')
+    parser.add_argument('--limit-rate', type = int, help = 'Bytes per second limit of the client, all transfers included')
+    parser.add_argument('--adaptive', action = 'store_true', help = 'Enables the adaptive transfers of the client')
+    parser.add_argument('--user', help = 'Enables digest authentication with this username')
+    parser.add_argument('--password', default = 'sweech', help = 'Digest authentication password')
+    parser.add_argument('--save', metavar = 'FILE', help = 'Save the results as JSON')
+    parser.add_argument('--baseline', metavar = 'FILE', help = 'Compare the results to previously saved ones')
+    parser.add_argument('--tolerance', type = float, default = 0.2,
+                        help = 'Slowdown ratio above which a scenario is reported as a regression')
+    parser.add_argument('--min-delta', type = float, default = 0.05,
+                        help = 'Slowdown in seconds below which a scenario is never reported as a regression')
+    parser.add_argument('--startup-target', type = float, default = 0.060,
+                        help = 'Maximum time in seconds a sweech command may add to the interpreter startup')
+    args = parser.parse_args()
+
+    results = _run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 4, sort_keys = True)
+    failures = [ '{} takes {:.3f}s more than the interpreter startup, the target is {:.3f}s'.format(
+                     key, result['overhead'], args.startup_target)
+                 for key, result in sorted(results.items())
+                 if key.startswith('startup/') and result['overhead'] > args.startup_target ]
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += [ 'Regression: ' + regression
+                          for regression in _compare(results, json.load(f), args.tolerance, args.min_delta) ]
+    for failure in failures:
+        sys.stderr.write(failure + '\n')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    _main()
@@ -21,7 +21,9 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
     ],
+    python_requires = '>=3.5',
     py_modules = ['sweech'],
     entry_points = {
         'console_scripts': [
@@ -4,26 +4,32 @@ from __future__ import print_function
 
 import argparse
 import codecs
+import io
 import json
 import os.path
-import ssl
+import posixpath
 import sys
-import types
+import time
 
-if sys.version > '3':
-    from urllib.parse import quote
-    from urllib.request import build_opener, urlopen, urlparse, AbstractDigestAuthHandler, \
-                               HTTPDigestAuthHandler, HTTPError, HTTPPasswordMgrWithDefaultRealm, \
-                               HTTPSHandler, Request, URLError
-else:
-    from urllib2 import quote, build_opener, urlopen, urlparse, AbstractDigestAuthHandler, \
-                               HTTPDigestAuthHandler, HTTPError, HTTPPasswordMgrWithDefaultRealm, \
-                               HTTPSHandler, Request, URLError
+from collections import OrderedDict, deque
+from urllib.parse import quote, urlparse
+from urllib.error import HTTPError, URLError
+
+# Modules which are slow to import (http.client, ssl, asyncio, urllib.request, threading...) are imported
+# where they are used, so that the command line starts fast, even for commands which don't use them
 
 
 # == Internal helper functions ================================================
 
 
+_clock = time.perf_counter
+
+
+_SYNC_MANIFEST = '.sweech-sync.json'
+_CHECKSUM_MANIFEST = '.sweech-checksums.json'
+_JOURNAL_PREFIX = '.sweech-journal-'
+
+
 def _ls_item_to_str(item):
     isDir = item['isDir']
     line = 'd' if isDir else '-'
@@ -49,26 +55,1484 @@ def _pretty_size(size):
         return '{:>6.1f}G'.format(size / (1024.0 * 1024.0 * 1024.0))
 
 
+def _remote_signature(item):
+    return dict((key, value) for key, value in item.items() if key not in ('name', 'isDir', 'isReadable', 'isWritable'))
+
+
+def _local_signature(path):
+    st = os.stat(path)
+    return [ st.st_size, int(st.st_mtime * 1000) ]
+
+
+def _load_json_file(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def _save_json_file(path, content):
+    import tempfile
+    # A unique temporary file lets concurrent writers each swap in a complete file
+    fd, tmp_path = tempfile.mkstemp(prefix = os.path.basename(path) + '.', suffix = '.tmp',
+                                    dir = os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(content, separators = (',', ':')).encode('utf-8'))
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _normalize_remote_path(path):
+    return '/' + path.strip('/')
+
+
+def _remote_ancestors(path):
+    """Returns the ancestors of a normalized remote path, excluding '/'"""
+    ancestors = []
+    path = os.path.split(path)[0]
+    while path not in ('/', ''):
+        ancestors.append(path)
+        path = os.path.split(path)[0]
+    return ancestors
+
+
+def _copy_stream(source, fileobj, chunk_size = 64 * 1024, hasher = None, controller = None):
+    """Copies the content of source to fileobj until the end of source is reached.
+    A single buffer is allocated and filled with `readinto`, and slices of it are written
+    without intermediate copies. Returns the number of bytes copied.
+    If hasher is set, its `update` method is called with the data copied.
+    If controller is set, it throttles the copy and chooses the size of the chunks.
+    """
+    sizer = controller.sizer() if controller is not None else None
+    buffer = bytearray(chunk_size if sizer is None else sizer.size)
+    view = memoryview(buffer)
+    copied = 0
+    while True:
+        if sizer is not None and sizer.size != len(buffer):
+            buffer = bytearray(sizer.size)
+            view = memoryview(buffer)
+        start = _clock()
+        size = source.readinto(buffer)
+        if not size:
+            return copied
+        fileobj.write(view[:size])
+        if hasher is not None:
+            hasher.update(view[:size])
+        copied += size
+        if controller is not None:
+            controller.transferred(size, sizer, _clock() - start)
+
+
 def _make_abs(args, path):
     if not path.startswith('/') and hasattr(args, 'defaultdir'):
         return args.defaultdir + '/' + path
     return path
 
 
-class HTTPSDigestAuthHandler(HTTPSHandler, AbstractDigestAuthHandler):
+class _WorkerPool(object):
+    """Runs tasks on at most `jobs` threads.
+    With a single job, tasks are run immediately in the calling thread, in submission order.
+    Tasks may submit other tasks. The first exception raised by a task cancels the remaining ones
+    and is raised again by `join`.
+    When used as a context manager, `join` is called on exit, or `cancel` if an exception occurred.
+    If set, tuner is called with the pool after each task and may change `jobs`; tasks are then always
+    run on threads.
+    """
+
+    def __init__(self, jobs = 1, tuner = None):
+        import threading
+        from queue import Queue
+        self.jobs = max(1, jobs or 1)
+        self._tuner = tuner
+        self._queue = Queue()
+        self._threads = []
+        self._pending = 0
+        self._error = None
+        self._cancelled = False
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.join()
+        else:
+            self.cancel()
+
+    def submit(self, function, *args):
+        if self.jobs == 1 and self._tuner is None:
+            function(*args)
+            return
+        with self._condition:
+            if self._error is not None or self._cancelled:
+                return
+            self._pending += 1
+            self._spawn()
+        self._queue.put((function, args))
+
+    def _spawn(self):
+        # Called with the condition held
+        import threading
+        while len(self._threads) < min(self.jobs, self._pending):
+            thread = threading.Thread(target = self._run)
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self):
+        import threading
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            function, args = task
+            try:
+                if self._error is None and not self._cancelled:
+                    function(*args)
+            except BaseException as err:
+                with self._condition:
+                    if self._error is None:
+                        self._error = err
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._condition.notify_all()
+            if self._tuner is not None:
+                self._tuner(self)
+                with self._condition:
+                    if len(self._threads) > self.jobs:
+                        # The pool has been shrunk
+                        self._threads.remove(threading.current_thread())
+                        return
+                    if not self._cancelled and self._error is None:
+                        self._spawn()
+
+    def _wait(self):
+        try:
+            with self._condition:
+                while self._pending > 0:
+                    # A timeout keeps the main thread responsive to KeyboardInterrupt
+                    self._condition.wait(0.5)
+        except BaseException:
+            self._cancelled = True
+            for thread in self._stop_threads():
+                self._queue.put(None)
+            raise
+        threads = self._stop_threads()
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _stop_threads(self):
+        # Threads leaving a shrunk pool may still be removing themselves from the list
+        with self._condition:
+            threads, self._threads = self._threads, []
+        return threads
+
+    def join(self):
+        """Waits for all tasks to complete and raises the first error encountered"""
+        self._wait()
+        if self._error is not None:
+            raise self._error
+
+    def cancel(self):
+        """Drops the tasks which haven't started yet and waits for the running ones"""
+        self._cancelled = True
+        self._wait()
+
+
+class _HashingReader(object):
+    """Wraps a file object opened for reading and hashes the data read from it.
+    Seeking back to the initial position restarts the hash.
+    """
+
+    def __init__(self, fileobj, algorithm):
+        import hashlib
+        self._fileobj = fileobj
+        self._algorithm = algorithm
+        self._start = fileobj.tell()
+        self.hasher = hashlib.new(algorithm)
+
+    def read(self, size = -1):
+        data = self._fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def seek(self, position):
+        import hashlib
+        if position != self._start:
+            raise ValueError('Can only seek back to the initial position')
+        self._fileobj.seek(position)
+        self.hasher = hashlib.new(self._algorithm)
+
+
+class _Fanout(object):
+    """Feeds the chunks of a file to several request bodies, reading the file only once.
+    Each body is a generator reading from a bounded queue: the file is read at the pace of the slowest
+    consumer, with a bounded amount of memory. Consumers which fail have to call `abandon`.
+    """
+
+    def __init__(self, fileobj, count, chunk_size = 64 * 1024, depth = 8):
+        from queue import Queue
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._queues = [ Queue(depth) for i in range(count) ]
+        self._abandoned = [ False ] * count
+
+    def body(self, index):
+        queue = self._queues[index]
+        while True:
+            chunk = queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+
+    def abandon(self, index):
+        from queue import Empty
+        self._abandoned[index] = True
+        try:
+            while True:
+                self._queues[index].get_nowait()
+        except Empty:
+            pass
+
+    def _put(self, chunk):
+        from queue import Full
+        for index, queue in enumerate(self._queues):
+            while not self._abandoned[index]:
+                try:
+                    queue.put(chunk, timeout = 0.5)
+                    break
+                except Full:
+                    pass
+
+    def run(self):
+        """Reads the file and feeds its chunks until its end"""
+        try:
+            while not all(self._abandoned):
+                chunk = self._fileobj.read(self._chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as err:
+            self._put(RuntimeError('Unable to read the local file: {}'.format(err)))
+            raise
+
+
+class _ChunkSizer(object):
+    """Chooses the size of the chunks of a single transfer stream, so that each one takes about
+    `TARGET_TIME` seconds
+    """
+
+    TARGET_TIME = 0.1
+    MIN_SIZE = 16 * 1024
+    MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, size, max_size):
+        self.max_size = max(self.MIN_SIZE, min(self.MAX_SIZE, max_size))
+        self.size = max(self.MIN_SIZE, min(self.max_size, size))
+
+    def update(self, nbytes, seconds):
+        if nbytes < self.size:
+            return
+        if seconds < self.TARGET_TIME / 4 and self.size < self.max_size:
+            self.size = min(self.max_size, self.size * 2)
+        elif seconds > self.TARGET_TIME * 4 and self.size > self.MIN_SIZE:
+            self.size = max(self.MIN_SIZE, self.size // 2)
+
+
+class _ControlledReader(object):
+    """Wraps a request body and reads it by chunks of the size chosen by a _TransferController,
+    whatever the size requested by http.client. The time between two reads is the time taken to
+    send the previous chunk.
+    """
+
+    def __init__(self, fileobj, controller):
+        self._fileobj = fileobj
+        self._controller = controller
+        self._sizer = controller.sizer()
+        self._previous = None
+
+    def _sent(self):
+        now = _clock()
+        if self._previous is not None:
+            size, start = self._previous
+            self._controller.transferred(size, self._sizer, now - start)
+        return now
+
+    def read(self, amt = -1):
+        now = self._sent()
+        data = self._fileobj.read(self._sizer.size)
+        self._previous = (len(data), now) if data else None
+        return data
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def seek(self, *args):
+        self._previous = None
+        return self._fileobj.seek(*args)
+
+
+class _TransferController(object):
+    """Controls the file transfers of a Connector.
+    If `rate_limit` is set, the bytes transferred by all streams together are limited to this number of
+    bytes per second by a token bucket. If `adaptive` is set, chunk sizes are tuned for each stream from
+    its measured throughput, and `tune` adjusts the number of concurrent transfers of a _WorkerPool.
+    """
+
+    TUNING_PERIOD = 0.25
+
+    def __init__(self, chunk_size = 64 * 1024, rate_limit = None, adaptive = False, max_jobs = 16):
+        import threading
+        self.chunk_size = chunk_size
+        self.rate_limit = rate_limit
+        self.adaptive = adaptive
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        # Token bucket, allowing bursts of half a second
+        self._capacity = rate_limit / 2.0 if rate_limit else 0
+        self._tokens = self._capacity
+        self._last = _clock()
+        # Throughput measurement of the current tuning period
+        self._period_start = _clock()
+        self._period_bytes = 0
+        self._previous_throughput = None
+        self._step = 1
+
+    @property
+    def active(self):
+        return bool(self.rate_limit or self.adaptive)
+
+    def sizer(self):
+        if not self.adaptive:
+            max_size = self.chunk_size
+        elif self.rate_limit:
+            # Small chunks keep the throttled throughput smooth
+            max_size = int(self.rate_limit * _ChunkSizer.TARGET_TIME)
+        else:
+            max_size = _ChunkSizer.MAX_SIZE
+        sizer = _ChunkSizer(self.chunk_size, max_size)
+        if not self.adaptive:
+            sizer.update = lambda nbytes, seconds: None
+        return sizer
+
+    def wrap(self, body):
+        """Returns a request body read by controlled chunks"""
+        if hasattr(body, 'read'):
+            return _ControlledReader(body, self)
+        return self._controlled_chunks(body)
+
+    def _controlled_chunks(self, chunks):
+        sizer = _ChunkSizer(self.chunk_size, self.chunk_size)
+        start = _clock()
+        for chunk in chunks:
+            yield chunk
+            now = _clock()
+            self.transferred(len(chunk), sizer, now - start)
+            start = _clock()
+
+    def transferred(self, nbytes, sizer, seconds):
+        """Records nbytes transferred by the stream of sizer in the given time, and waits if the rate
+        limit is exceeded
+        """
+        sizer.update(nbytes, seconds)
+        delay = 0
+        with self._lock:
+            self._period_bytes += nbytes
+            if self.rate_limit:
+                now = _clock()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self.rate_limit) - nbytes
+                self._last = now
+                if self._tokens < 0:
+                    delay = -self._tokens / float(self.rate_limit)
+        if delay > 0:
+            time.sleep(delay)
+
+    def tune(self, pool):
+        """Adjusts the number of jobs of pool by one step every `TUNING_PERIOD` seconds: in the same
+        direction as long as the throughput improves, in the other direction otherwise
+        """
+        with self._lock:
+            now = _clock()
+            if now - self._period_start < self.TUNING_PERIOD:
+                return
+            throughput = self._period_bytes / (now - self._period_start)
+            self._period_start = now
+            self._period_bytes = 0
+            if self._previous_throughput is not None and throughput < self._previous_throughput * 0.95:
+                self._step = -self._step
+            self._previous_throughput = throughput
+            pool.jobs = max(1, min(self.max_jobs, pool.jobs + self._step))
+
+    def pool(self, jobs):
+        """Returns a _WorkerPool starting with `jobs` jobs, tuned if adaptive"""
+        return _WorkerPool(jobs, self.tune if self.adaptive else None)
+
+
+class _ChecksumManifest(object):
+    """Checksums of transferred files, relative to a local base directory.
+    They are stored in a JSON sidecar file in this directory, together with the metadata of the remote files.
+    """
+
+    def __init__(self, algorithm, base_dir):
+        import hashlib
+        import threading
+        hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.path = os.path.join(base_dir, _CHECKSUM_MANIFEST)
+        content = _load_json_file(self.path) or {}
+        self._previous = content.get('files', {}) if content.get('algorithm') == algorithm else {}
+        self._entries = dict(self._previous)
+        self._pending = []
+        self._failures = []
+        self._lock = threading.Lock()
+
+    def new_hasher(self):
+        import hashlib
+        return hashlib.new(self.algorithm)
+
+    def add_pending(self, remote_path, relpath, size, digest):
+        """Registers an uploaded file whose remote size has to be checked"""
+        with self._lock:
+            self._pending.append((remote_path, relpath, size, digest))
+
+    def pop_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        return pending
+
+    def fail(self, relpath, reason):
+        with self._lock:
+            self._failures.append('{}: {}'.format(relpath, reason))
+
+    def record(self, relpath, size, digest, remote):
+        """Records a transferred file, checking it against the remote size and the previous checksum
+        of the same remote file if its metadata hasn't changed since.
+        """
+        previous = self._previous.get(relpath)
+        if size != remote['size']:
+            self.fail(relpath, '{} bytes transferred, {} bytes on the device'.format(size, remote['size']))
+        elif previous is not None and previous.get('remote') == remote and previous[self.algorithm] != digest:
+            self.fail(relpath, '{} checksum differs from the previous transfer'.format(self.algorithm))
+        else:
+            with self._lock:
+                self._entries[relpath] = { 'size': size, self.algorithm: digest, 'remote': remote }
+
+    def save(self):
+        """Writes the manifest and raises RuntimeError if some files failed the verification"""
+        with self._lock:
+            _save_json_file(self.path, { 'algorithm': self.algorithm, 'files': self._entries })
+            failures = sorted(self._failures)
+        if failures:
+            raise RuntimeError('Verification failed:\n' + '\n'.join(failures))
+
+
+class _TransferJournal(object):
+    """Journal of a tree transfer, stored as JSON lines: the first one describes the transfer and the
+    planned items, each following one holds the index of a completed item. It is written as the transfer
+    progresses, so that an interrupted transfer can be continued with the items which aren't completed.
+    """
+
+    def __init__(self, path, transfer):
+        import threading
+        self.path = path
+        self.transfer = transfer
+        self.items = []
+        self.done = set()
+        self.start = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads the items of an interrupted transfer and the completed ones"""
+        header = None
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                lines = f.read().decode('utf-8').splitlines()
+            try:
+                header = json.loads(lines[0])
+            except (IndexError, ValueError):
+                pass
+        if header is None or header.get('transfer') != self.transfer:
+            raise RuntimeError("No interrupted transfer to continue ('{}' not found)".format(self.path))
+        self.items = header['items']
+        self.start = header['start']
+        for line in lines[1:]:
+            try:
+                self.done.add(int(line))
+            except ValueError:
+                # Interrupted while the line was written
+                pass
+        self._file = open(self.path, 'ab')
+
+    def create(self, items):
+        """Starts the journal of a new transfer. Returns False if it can't be written (ex: read-only
+        directory), the items are then transferred without being recorded.
+        """
+        self.items = items
+        self.start = time.time()
+        header = { 'transfer': self.transfer, 'start': self.start, 'items': items }
+        try:
+            self._file = open(self.path, 'wb')
+            self._file.write(json.dumps(header, separators = (',', ':')).encode('utf-8') + b'\n')
+            self._file.flush()
+        except (IOError, OSError):
+            try:
+                self.close(remove = True)
+            except (IOError, OSError):
+                pass
+            return False
+        return True
+
+    def complete(self, index):
+        with self._lock:
+            if self._file is not None:
+                self._file.write('{}\n'.format(index).encode('utf-8'))
+                self._file.flush()
+
+    def close(self, remove = False):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _TransferStats(object):
+    """Aggregates request and file events"""
+
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self._totals = dict((key, 0) for key in ('requests', 'errors', 'connections', 'challenges', 'connect', 'auth',
+                                                 'ttfb', 'transfer', 'received', 'sent', 'files', 'file_bytes',
+                                                 'file_time'))
+        self._first = None
+        self._last = None
+
+    def add(self, event):
+        with self._lock:
+            totals = self._totals
+            if event['type'] == 'request':
+                duration = event['connect'] + event['auth'] + event['ttfb'] + event['transfer']
+                totals['requests'] += 1
+                totals['errors'] += 1 if event['status'] >= 400 else 0
+                totals['connections'] += event['connections']
+                totals['challenges'] += 1 if event['auth'] > 0 else 0
+                for key in ('connect', 'auth', 'ttfb', 'transfer'):
+                    totals[key] += event[key]
+                totals['received'] += event['bytes']
+                totals['sent'] += event['sent']
+            else:
+                duration = event['duration']
+                totals['files'] += 1
+                totals['file_bytes'] += event['bytes']
+                totals['file_time'] += duration
+            end = event['start'] + duration
+            self._first = event['start'] if self._first is None else min(self._first, event['start'])
+            self._last = end if self._last is None else max(self._last, end)
+
+    def summary(self):
+        with self._lock:
+            summary = dict(self._totals)
+            summary['elapsed'] = self._last - self._first if self._first is not None else 0.0
+        return summary
+
+
+class _TraceWriter(object):
+    """Writes events to a file in the Chrome trace event format, one event per line"""
+
+    def __init__(self, path):
+        import threading
+        self._file = open(path, 'w')
+        self._file.write('[')
+        self._separator = '\n'
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __call__(self, event):
+        import threading
+        if event['type'] == 'request':
+            name = '{} {}'.format(event['method'], event['path'])
+            duration = event['connect'] + event['auth'] + event['ttfb'] + event['transfer']
+            args = dict((key, event[key]) for key in ('status', 'connect', 'auth', 'ttfb', 'transfer', 'bytes', 'sent'))
+        else:
+            name = event['path']
+            duration = event['duration']
+            args = { 'direction': event['direction'], 'bytes': event['bytes'] }
+        trace_event = { 'name': name, 'cat': event['type'], 'ph': 'X', 'ts': int(event['start'] * 1000000),
+                        'dur': int(duration * 1000000), 'pid': self._pid, 'tid': threading.current_thread().ident,
+                        'args': args }
+        with self._lock:
+            self._file.write(self._separator + json.dumps(trace_event))
+            self._separator = ',\n'
+
+    def close(self):
+        with self._lock:
+            self._file.write('\n]\n')
+            self._file.close()
+
+
+class _ListingCache(object):
+    """LRU cache of `/api/ls` responses whose entries expire after `ttl` seconds.
+    If `path` is set, entries are loaded from this JSON file and saved back by `save`.
+    """
+
+    def __init__(self, ttl, max_entries = 1024, path = None):
+        import threading
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            for key, entry in (_load_json_file(path) or []):
+                self._entries[key] = tuple(entry)
+
+    @staticmethod
+    def _key(path):
+        return '/' + path.strip('/')
+
+    def get(self, path):
+        key = self._key(path)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def put(self, path, response):
+        key = self._key(path)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), response)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def invalidate(self, path = None):
+        """Drops the entries of path, its ancestors and its descendants, or all entries if path is None"""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            key = self._key(path)
+            for cached_key in list(self._entries.keys()):
+                if cached_key == key or cached_key.startswith(key.rstrip('/') + '/') \
+                   or key.startswith(cached_key.rstrip('/') + '/'):
+                    del self._entries[cached_key]
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            now = time.time()
+            entries = [ [ key, list(entry) ] for key, entry in self._entries.items() if now - entry[0] <= self.ttl ]
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        _save_json_file(self.path, entries)
+
+
+class _ContentCache(object):
+    """On-disk LRU cache of file contents, limited to `max_size` bytes in `directory`.
+    Entries are keyed by device and remote path, and are only served while the size and modification
+    time reported by `/api/ls` are unchanged. Files larger than an eighth of the cache aren't stored.
+    The modification time of the cached files records their last use, the least recently used ones
+    are evicted first.
+    """
+
+    def __init__(self, directory, max_size = 256 * 1024 * 1024):
+        import threading
+        self.directory = directory
+        self.max_size = max_size
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # Called with the lock held
+        if self._entries is None:
+            self._entries = {}
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    local_path = os.path.join(self.directory, name)
+                    try:
+                        st = os.stat(local_path)
+                        if not name.endswith('.tmp'):
+                            self._entries[name] = [ st.st_size, st.st_mtime ]
+                        elif time.time() - st.st_mtime > 24 * 3600:
+                            # Left by an interrupted process
+                            os.remove(local_path)
+                    except OSError:
+                        # Removed by another process
+                        pass
+            self._evict()
+        return self._entries
+
+    def _evict(self):
+        # Called with the lock held
+        total = sum(size for size, _ in self._entries.values())
+        for name in sorted(self._entries, key = lambda name: self._entries[name][1]):
+            if total <= self.max_size:
+                break
+            total -= self._entries[name][0]
+            self._remove(name)
+
+    @staticmethod
+    def _names(device, path, item):
+        """Returns the prefix shared by all the versions of a remote file, and the name of this version"""
+        import hashlib
+        key = device.rstrip('/') + '\n' + _normalize_remote_path(path)
+        prefix = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        signature = json.dumps(_remote_signature(item), sort_keys = True)
+        return prefix, prefix + '-' + hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+
+    def _remove(self, name):
+        # Called with the lock held
+        del self._entries[name]
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def open(self, device, path, item):
+        """Returns the cached content of the remote file described by item opened in binary mode, or None"""
+        prefix, name = self._names(device, path, item)
+        with self._lock:
+            entries = self._load()
+            if name not in entries:
+                return None
+            local_path = os.path.join(self.directory, name)
+            try:
+                os.utime(local_path, None)
+                fileobj = open(local_path, 'rb')
+            except OSError:
+                self._remove(name)
+                return None
+            entries[name][1] = time.time()
+            return fileobj
+
+    def cacheable(self, item):
+        return item['size'] <= self.max_size // 8
+
+    def temporary_file(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok = True)
+        return open(os.path.join(self.directory, os.urandom(8).hex() + '.tmp'), 'w+b')
+
+    def commit(self, device, path, item, tmp_path):
+        """Stores the temporary file at tmp_path as the content of the remote file described by item"""
+        prefix, name = self._names(device, path, item)
+        with self._lock:
+            entries = self._load()
+            if os.path.getsize(tmp_path) != item['size']:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, os.path.join(self.directory, name))
+            for other in [ other for other in entries if other.startswith(prefix) and other != name ]:
+                # Outdated versions of the same file
+                self._remove(other)
+            entries[name] = [ item['size'], time.time() ]
+            self._evict()
+
+    def reader(self, device, path, item, response):
+        """Returns a file-like object reading response and storing its content in the cache once it has been
+        read entirely, or response itself if the file is too large to be cached
+        """
+        if not self.cacheable(item):
+            return response
+        return _CachingReader(self, device, path, item, response)
+
+
+class _CachingReader(object):
+    """Reads a response and copies its content to a _ContentCache temporary file, committed at the end of the
+    content
+    """
 
-    def __init__(self, passwordmgr, context):
-        HTTPSHandler.__init__(self, context = context)
-        AbstractDigestAuthHandler.__init__(self, passwordmgr)
+    def __init__(self, cache, device, path, item, response):
+        self._cache = cache
+        self._key = (device, path, item)
+        self._response = response
+        self._file = cache.temporary_file()
 
-    auth_header = 'Authorization'
-    handler_order = 490  # before Basic auth
+    def __enter__(self):
+        return self
 
-    def http_error_401(self, req, fp, code, msg, headers):
-        host = urlparse(req.full_url)[1]
-        retry = self.http_error_auth_reqed('www-authenticate', host, req, headers)
-        self.reset_retry_count()
-        return retry
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def info(self):
+        return self._response.info()
+
+    def _copied(self, data):
+        if self._file is None:
+            return
+        if len(data) > 0:
+            self._file.write(data)
+            return
+        self._file.close()
+        self._cache.commit(*(self._key + (self._file.name,)))
+        self._file = None
+
+    def readinto(self, b):
+        size = self._response.readinto(b)
+        self._copied(memoryview(b)[:size])
+        return size
+
+    def read(self, amt = None):
+        data = self._response.read(amt)
+        if amt is None or amt > 0:
+            self._copied(data)
+        if amt is None and len(data) > 0:
+            self._copied(b'')
+        return data
+
+    def close(self):
+        self._response.close()
+        if self._file is not None:
+            # Incomplete content
+            self._file.close()
+            os.remove(self._file.name)
+            self._file = None
+
+
+class _DigestAuth(object):
+    """Computes HTTP digest `Authorization` headers.
+    The last challenge received is cached so that the following requests are authenticated
+    pre-emptively, with an incrementing nonce count, instead of waiting for a 401 response.
+    """
+
+    def __init__(self, user, password):
+        import threading
+        self.user = user
+        self.password = password or ''
+        self._challenge = None
+        self._nonce_count = 0
+        self._lock = threading.Lock()
+
+    def update(self, header):
+        """Caches the challenge of a `WWW-Authenticate` header.
+        Returns False if it isn't a digest challenge.
+        """
+        if header is None:
+            return False
+        scheme, _, fields = header.partition(' ')
+        if scheme.lower() != 'digest':
+            return False
+        from urllib.request import parse_http_list, parse_keqv_list
+        challenge = parse_keqv_list(parse_http_list(fields))
+        if 'nonce' not in challenge:
+            return False
+        with self._lock:
+            self._challenge = challenge
+            self._nonce_count = 0
+        return True
+
+    def header(self, method, uri):
+        """Returns the `Authorization` header value for a request or None if no challenge is known"""
+        import hashlib
+        with self._lock:
+            if self._challenge is None:
+                return None
+            self._nonce_count += 1
+            nonce_count = '{:08x}'.format(self._nonce_count)
+            challenge = self._challenge
+        algorithm = challenge.get('algorithm', 'MD5')
+        digest = lambda data: hashlib.md5(data.encode('utf-8')).hexdigest()
+        realm = challenge.get('realm', '')
+        nonce = challenge['nonce']
+        cnonce = hashlib.md5(os.urandom(16)).hexdigest()[:16]
+        ha1 = digest('{}:{}:{}'.format(self.user, realm, self.password))
+        if algorithm.upper() == 'MD5-SESS':
+            ha1 = digest('{}:{}:{}'.format(ha1, nonce, cnonce))
+        ha2 = digest('{}:{}'.format(method, uri))
+        qops = [ qop.strip() for qop in challenge.get('qop', '').split(',') ]
+        fields = [ ('username', self.user), ('realm', realm), ('nonce', nonce), ('uri', uri) ]
+        if 'auth' in qops:
+            response = digest(':'.join([ ha1, nonce, nonce_count, cnonce, 'auth', ha2 ]))
+        else:
+            response = digest(':'.join([ ha1, nonce, ha2 ]))
+        fields.append(('response', response))
+        if 'opaque' in challenge:
+            fields.append(('opaque', challenge['opaque']))
+        header = 'Digest ' + ', '.join('{}="{}"'.format(key, value) for key, value in fields)
+        header += ', algorithm={}'.format(algorithm)
+        if 'auth' in qops:
+            header += ', qop=auth, nc={}, cnonce="{}"'.format(nonce_count, cnonce)
+        return header
+
+
+class _Response(object):
+    """File-like object holding the body of an HTTP response.
+    Its connection is given back to the pool once the body has been entirely read,
+    or closed if the response is closed before.
+    """
+
+    def __init__(self, client, connection, response, event = None, headers_time = None):
+        self._client = client
+        self._connection = connection
+        self._response = response
+        self._event = event
+        self._headers_time = headers_time
+        self._received = 0
+        self.status = response.status
+        content_length = response.getheader('Content-Length')
+        chunked = response.getheader('Transfer-Encoding', '').lower() == 'chunked'
+        self._remaining = int(content_length) if content_length is not None and not chunked else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default = None):
+        return self._response.getheader(name, default)
+
+    def _check_complete(self):
+        if self._connection is not None and self._response.isclosed():
+            self._client._release(self._connection)
+            self._connection = None
+            self._emit_event()
+
+    def _emit_event(self):
+        if self._event is not None:
+            self._event['transfer'] = _clock() - self._headers_time
+            self._event['bytes'] = self._received
+            self._client._emit(self._event)
+            self._event = None
+
+    def _count(self, size, requested):
+        self._received += size
+        if self._remaining is not None:
+            if size == 0 and requested > 0 and self._remaining > 0:
+                # The connection has been closed before the end of the body
+                self.close()
+                raise URLError('Incomplete response: {} bytes missing'.format(self._remaining))
+            self._remaining -= size
+
+    def read(self, amt = None):
+        from http.client import HTTPException
+        try:
+            data = self._response.read() if amt is None else self._response.read(amt)
+        except HTTPException as err:
+            self.close()
+            raise URLError('Incomplete response')
+        self._count(len(data), 1 if amt is None else amt)
+        if amt is None or len(data) == 0:
+            self._response.close()
+        self._check_complete()
+        return data
+
+    def readinto(self, b):
+        from http.client import HTTPException
+        try:
+            size = self._response.readinto(b)
+        except HTTPException as err:
+            self.close()
+            raise URLError('Incomplete response')
+        self._count(size, len(b))
+        if size == 0:
+            self._response.close()
+        self._check_complete()
+        return size
+
+    def close(self):
+        if self._connection is not None:
+            if not self._response.isclosed():
+                self._connection.close()
+            self._response.close()
+            self._check_complete()
+        self._emit_event()
+
+
+class _FileBody(object):
+    """A request body sent straight from a file opened in binary mode, without reading it in Python:
+    with `socket.sendfile`, which lets the kernel copy the data, on plain sockets, or by writing large
+    slices of a memory map of the file on TLS sockets and where `os.sendfile` isn't available.
+    `size` bytes are sent from the current position of the file.
+    If set, progress is called with the number of bytes sent so far and size after each slice.
+    """
+
+    SLICE_SIZE = 1024 * 1024
+
+    def __init__(self, fileobj, size, progress = None):
+        self._fileobj = fileobj
+        self._offset = fileobj.tell()
+        self.size = size
+        self._progress = progress
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset):
+        self._offset = offset
+
+    def send(self, sock):
+        import ssl
+        if self.size == 0:
+            if self._progress is not None:
+                self._progress(0, 0)
+            return
+        if hasattr(os, 'sendfile') and not isinstance(sock, ssl.SSLSocket):
+            sent = 0
+            while sent < self.size:
+                count = sock.sendfile(self._fileobj, self._offset + sent, min(self.SLICE_SIZE, self.size - sent))
+                if count == 0:
+                    raise IOError('File truncated while it was sent')
+                sent += count
+                if self._progress is not None:
+                    self._progress(sent, self.size)
+            return
+        import mmap
+        # The mapping starts at an offset multiple of the allocation granularity
+        start = self._offset - self._offset % mmap.ALLOCATIONGRANULARITY
+        try:
+            mapping = mmap.mmap(self._fileobj.fileno(), self._offset - start + self.size, access = mmap.ACCESS_READ,
+                                offset = start)
+        except ValueError as err:
+            # The file is shorter than expected
+            raise IOError(err)
+        try:
+            with memoryview(mapping) as view:
+                sent = 0
+                while sent < self.size:
+                    position = self._offset - start + sent
+                    sock.sendall(view[position:position + min(self.SLICE_SIZE, self.size - sent)])
+                    sent = min(self.size, sent + self.SLICE_SIZE)
+                    if self._progress is not None:
+                        self._progress(sent, self.size)
+        finally:
+            mapping.close()
+
+
+class _RangeReader(object):
+    """Extracts a byte range from a response which ignored the `Range` header"""
+
+    def __init__(self, response, skip, length = None):
+        self._response = response
+        self._skip = skip
+        self._remaining = length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def info(self):
+        return self._response.info()
+
+    def _skip_prefix(self):
+        while self._skip > 0:
+            skipped = len(self._response.read(min(self._skip, 64 * 1024)))
+            if skipped == 0:
+                self._skip = 0
+                break
+            self._skip -= skipped
+
+    def readinto(self, b):
+        self._skip_prefix()
+        view = memoryview(b)
+        if self._remaining is not None:
+            if self._remaining == 0:
+                return 0
+            view = view[:self._remaining]
+        size = self._response.readinto(view)
+        if self._remaining is not None:
+            self._remaining -= size
+        return size
+
+    def read(self, amt = None):
+        self._skip_prefix()
+        if self._remaining is not None:
+            amt = self._remaining if amt is None else min(amt, self._remaining)
+            if amt == 0:
+                return b''
+        data = self._response.read(amt)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._response.close()
+
+
+class _HTTPClient(object):
+    """Sends requests to a single host over a small pool of persistent connections"""
+
+    def __init__(self, base_url, user = None, password = None, max_idle = 8, event_function = None):
+        import ssl
+        import threading
+        url = urlparse(base_url)
+        self._https = url.scheme == 'https'
+        self._host = url.netloc
+        self._prefix = url.path.rstrip('/')
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23) if self._https else None
+        self._auth = _DigestAuth(user, password) if user else None
+        self._event_function = event_function
+
+    def _emit(self, event):
+        if self._event_function is not None:
+            self._event_function(event)
+
+    def _acquire(self, reuse = True):
+        from http.client import HTTPConnection, HTTPSConnection
+        with self._lock:
+            if reuse and self._idle:
+                return self._idle.pop(), True
+        if self._https:
+            return HTTPSConnection(self._host, context = self._ssl_context), False
+        return HTTPConnection(self._host), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def request(self, path, body = None, headers = {}):
+        """Sends a POST request if body is not None, a GET request otherwise.
+        Raises HTTPError on HTTP error statuses and URLError on connection failures.
+        """
+        import socket
+        from http.client import HTTPException
+        method = 'GET' if body is None else 'POST'
+        url = self._prefix + path
+        body_position = body.tell() if hasattr(body, 'tell') else None
+        replayable = body is None or isinstance(body, bytes) or body_position is not None
+        authenticated = False
+        event = None
+        if self._event_function is not None:
+            sent = len(body) if isinstance(body, bytes) else int(headers.get('Content-Length', 0))
+            event = { 'type': 'request', 'method': method, 'path': url, 'start': time.time(), 'connections': 0,
+                      'connect': 0.0, 'auth': 0.0, 'sent': sent }
+        while True:
+            request_headers = dict(headers)
+            authorization = self._auth.header(method, url) if self._auth else None
+            if authorization is not None:
+                request_headers['Authorization'] = authorization
+            # The server may have closed an idle connection, a body which can't be sent again needs a new one
+            connection, reused = self._acquire(replayable)
+            attempt_time = _clock()
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    if event is not None:
+                        event['connections'] += 1
+                        event['connect'] += _clock() - attempt_time
+                        attempt_time = _clock()
+                if isinstance(body, _FileBody):
+                    connection.putrequest(method, url)
+                    for key, value in request_headers.items():
+                        connection.putheader(key, value)
+                    connection.endheaders()
+                    body.send(connection.sock)
+                else:
+                    connection.request(method, url, body, request_headers)
+                response = connection.getresponse()
+            except (socket.error, HTTPException) as err:
+                connection.close()
+                if reused and replayable:
+                    # The server has closed an idle connection, send the request again on a new one
+                    if body_position is not None:
+                        body.seek(body_position)
+                    continue
+                raise URLError(err)
+            headers_time = _clock()
+            if event is not None:
+                event['status'] = response.status
+                event['ttfb'] = headers_time - attempt_time
+            if response.status >= 400:
+                content = response.read()
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._release(connection)
+                # The challenge is updated even if the body can't be sent again, for the following requests
+                if response.status == 401 and self._auth is not None and not authenticated \
+                   and self._auth.update(response.getheader('WWW-Authenticate')) and replayable:
+                    # No challenge known yet or stale nonce: answer the new challenge once
+                    authenticated = True
+                    if event is not None:
+                        event['auth'] += _clock() - attempt_time
+                    if body_position is not None:
+                        body.seek(body_position)
+                    continue
+                if event is not None:
+                    event['transfer'] = _clock() - headers_time
+                    event['bytes'] = len(content)
+                    self._emit(event)
+                raise HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(content))
+            return _Response(self, connection, response, event, headers_time)
+
+
+class _AsyncResponse(object):
+    """Body of an HTTP response read from an asyncio stream.
+    Its connection is given back to the pool once the body has been entirely read.
+    Reading can be restricted to a byte range with `skip` and `limit`, or to the last `tail` bytes when the
+    size of the body isn't known.
+    """
+
+    def __init__(self, client, reader, writer, status, reason, headers, keep_alive):
+        self._client = client
+        self._reader = reader
+        self._writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._keep_alive = keep_alive
+        self._chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self._chunk_left = 0
+        content_length = headers.get('content-length')
+        self._remaining = int(content_length) if content_length is not None and not self._chunked else None
+        self._done = False
+        self.skip = 0
+        self.limit = None
+        self.tail = None
+        self._buffer = None
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read(64 * 1024)
+        if len(data) == 0:
+            raise StopAsyncIteration
+        return data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _finish(self, reusable):
+        if not self._done:
+            self._done = True
+            if reusable and self._keep_alive:
+                self._client._release(self._reader, self._writer)
+            else:
+                self._writer.close()
+
+    async def _read_raw(self, amt):
+        if self._done:
+            return b''
+        if self._chunked:
+            if self._chunk_left == 0:
+                line = await self._reader.readline()
+                self._chunk_left = int(line.split(b';')[0].strip(), 16)
+                if self._chunk_left == 0:
+                    while (await self._reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    self._finish(True)
+                    return b''
+            data = await self._reader.read(min(amt, self._chunk_left))
+            if len(data) == 0:
+                self._finish(False)
+                raise URLError('Incomplete response')
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._reader.readexactly(2)
+            return data
+        if self._remaining is not None:
+            if self._remaining == 0:
+                self._finish(True)
+                return b''
+            data = await self._reader.read(min(amt, self._remaining))
+            if len(data) == 0:
+                self._finish(False)
+                raise URLError('Incomplete response')
+            self._remaining -= len(data)
+            if self._remaining == 0:
+                self._finish(True)
+            return data
+        data = await self._reader.read(amt)
+        if len(data) == 0:
+            self._finish(False)
+        return data
+
+    async def read(self, amt = -1):
+        """Reads up to amt bytes, or the whole body if amt is negative"""
+        if amt is None or amt < 0:
+            chunks = []
+            while True:
+                data = await self.read(64 * 1024)
+                if len(data) == 0:
+                    return b''.join(chunks)
+                chunks.append(data)
+        while self.skip > 0:
+            skipped = len(await self._read_raw(min(self.skip, 64 * 1024)))
+            self.skip = 0 if skipped == 0 else self.skip - skipped
+        if self.tail is not None:
+            # The whole body is read, keeping its last bytes only
+            buffer = bytearray()
+            while True:
+                data = await self._read_raw(64 * 1024)
+                if len(data) == 0:
+                    break
+                buffer += data
+                if len(buffer) > 2 * self.tail:
+                    del buffer[:-self.tail]
+            self._buffer = io.BytesIO(bytes(buffer[-self.tail:]))
+            self.tail = None
+        if self.limit is not None:
+            amt = min(amt, self.limit)
+            if amt == 0:
+                return b''
+        data = self._buffer.read(amt) if self._buffer is not None else await self._read_raw(amt)
+        if self.limit is not None:
+            self.limit -= len(data)
+        return data
+
+    def close(self):
+        self._finish(False)
+
+
+class _AsyncHTTPClient(object):
+    """asyncio counterpart of _HTTPClient"""
+
+    def __init__(self, base_url, user = None, password = None, max_idle = 8):
+        import ssl
+        url = urlparse(base_url)
+        self._https = url.scheme == 'https'
+        self._netloc = url.netloc
+        self._hostname = url.hostname
+        self._port = url.port or (443 if self._https else 80)
+        self._prefix = url.path.rstrip('/')
+        self._max_idle = max_idle
+        self._idle = []
+        self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23) if self._https else None
+        self._auth = _DigestAuth(user, password) if user else None
+
+    async def _acquire(self):
+        import asyncio
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(self._hostname, self._port, ssl = self._ssl_context)
+        return reader, writer, False
+
+    def _release(self, reader, writer):
+        if len(self._idle) < self._max_idle:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for reader, writer in idle:
+            writer.close()
+
+    async def _send(self, reader, writer, method, url, body, headers):
+        lines = [ '{} {} HTTP/1.1'.format(method, url), 'Host: {}'.format(self._netloc), 'Accept-Encoding: identity' ]
+        if body is not None and 'Content-Length' not in headers:
+            lines.append('Content-Length: {}'.format(len(body)))
+        for key, value in headers.items():
+            lines.append('{}: {}'.format(key, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            while True:
+                data = body.read(64 * 1024)
+                if len(data) == 0:
+                    break
+                writer.write(data)
+                await writer.drain()
+        await writer.drain()
+        status_line = await reader.readline()
+        if len(status_line) == 0:
+            raise ConnectionResetError('Connection closed by the server')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [ '' ])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and (version != 'HTTP/1.0' or connection == 'keep-alive')
+        return _AsyncResponse(self, reader, writer, int(status), reason, headers, keep_alive)
+
+    async def request(self, path, body = None, headers = {}):
+        """Sends a POST request if body is not None, a GET request otherwise.
+        Raises HTTPError on HTTP error statuses and URLError on connection failures.
+        """
+        method = 'GET' if body is None else 'POST'
+        url = self._prefix + path
+        body_position = body.tell() if hasattr(body, 'tell') else None
+        replayable = body is None or isinstance(body, bytes) or body_position is not None
+        authenticated = False
+        while True:
+            request_headers = dict(headers)
+            authorization = self._auth.header(method, url) if self._auth else None
+            if authorization is not None:
+                request_headers['Authorization'] = authorization
+            reader, writer, reused = await self._acquire()
+            try:
+                response = await self._send(reader, writer, method, url, body, request_headers)
+            except (OSError, ValueError, EOFError) as err:
+                writer.close()
+                if reused and replayable:
+                    # The server has closed an idle connection, send the request again on a new one
+                    if body_position is not None:
+                        body.seek(body_position)
+                    continue
+                raise URLError(err)
+            if response.status >= 400:
+                content = await response.read()
+                if response.status == 401 and self._auth is not None and not authenticated and replayable \
+                   and self._auth.update(response.getheader('WWW-Authenticate')):
+                    # No challenge known yet or stale nonce: answer the new challenge once
+                    authenticated = True
+                    if body_position is not None:
+                        body.seek(body_position)
+                    continue
+                raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(content))
+            return response
 
 
 # == Sweech access ============================================================
@@ -77,21 +1541,57 @@ class HTTPSDigestAuthHandler(HTTPSHandler, AbstractDigestAuthHandler):
 class Connector(object):
     """A Connector is used to access to an Android device running Sweech"""
 
-    def __init__(self, base_url, user = None, password = None, log_function = None):
+    def __init__(self, base_url, user = None, password = None, log_function = None,
+                 cache_ttl = None, cache_size = 1024, cache_path = None, chunk_size = 64 * 1024,
+                 event_function = None, rate_limit = None, adaptive = False, content_cache_path = None,
+                 content_cache_size = 256 * 1024 * 1024):
         """
         Args:
             base_url (str): the URL displayed in the Sweech app (ex: 'http://192.168.0.65:4444')
             user (str, optional): the username if login is enabled in the app
             password (str, optional): the password if login is enabled in the app
             log_function (function): a function to be called to log runtime information
+            cache_ttl (float, optional): if set, directory listings are cached for this number of seconds.
+                The cache is invalidated by the changes made through this Connector only.
+            cache_size (int): maximum number of cached listings
+            cache_path (str, optional): a JSON file where cached listings are loaded from and saved to by `close`
+            chunk_size (int): size of the buffer used to stream downloaded files, and of the chunks of uploaded
+                files when the transfers are controlled (see rate_limit and adaptive)
+            event_function (function, optional): a function called with a dict for each completed request
+                and transferred file, from the thread which completed it. Request events ('type': 'request')
+                hold the 'method', 'path', 'status', 'start' time (seconds since the epoch), 'bytes' received,
+                'sent' bytes, number of 'connections' opened, and the seconds spent to 'connect', answer
+                an 'auth' challenge, wait for the response headers ('ttfb') and 'transfer' the response body.
+                File events ('type': 'file') hold the 'direction' ('download' or 'upload'), remote 'path',
+                'start' time, 'bytes' and 'duration'.
+            rate_limit (int, optional): maximum number of bytes per second transferred by `pull`, `push`, `sync`,
+                and `download`, all concurrent transfers included
+            adaptive (bool): if true, the size of the chunks of each transfer is tuned from its measured
+                throughput (the first chunks use chunk_size), and the `jobs` given to `pull` and `push` is
+                the initial number of concurrent transfers, tuned from the overall throughput up to 16
+            content_cache_path (str, optional): a directory where the content of the whole files read by
+                `cat`, `download` and `pull` is cached. A cached file is served without downloading it again as
+                long as the size and modification time listed by the device are unchanged.
+            content_cache_size (int): maximum number of bytes in content_cache_path, the least recently used
+                files are evicted first
         """
+        import threading
         self.base_url = base_url
+        self.chunk_size = chunk_size
+        self._transfer = _TransferController(chunk_size, rate_limit, adaptive)
         self._log_function = log_function
-        passwordmgr = HTTPPasswordMgrWithDefaultRealm()
-        passwordmgr.add_password('Sweech', base_url, user, password)
-        auth_handler = HTTPDigestAuthHandler(passwordmgr)
-        https_auth_handler = HTTPSDigestAuthHandler(passwordmgr, ssl.SSLContext(ssl.PROTOCOL_SSLv23))
-        self._opener = build_opener(auth_handler, https_auth_handler)
+        self._log_lock = threading.Lock()
+        self._event_function = event_function
+        self._stats = _TransferStats()
+        self._client = _HTTPClient(base_url, user, password, event_function = self._emit)
+        self._listing_cache = _ListingCache(cache_ttl, cache_size, cache_path) if cache_ttl is not None else None
+        self._content_cache = _ContentCache(content_cache_path, content_cache_size) if content_cache_path else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
     # == Internal functions ===================================================
@@ -99,10 +1599,16 @@ class Connector(object):
 
     def _log(self, msg):
         if self._log_function:
-            self._log_function(msg)
+            with self._log_lock:
+                self._log_function(msg)
+
+    def _emit(self, event):
+        self._stats.add(event)
+        if self._event_function:
+            self._event_function(event)
 
     def _urlopen(self, path, postdata = None, headers = {}):
-        return self._opener.open(Request(self.base_url + quote(path.encode('utf-8')), data = postdata, headers = headers))
+        return self._client.request(quote(path.encode('utf-8')), postdata, headers)
 
 
     def _fetch_json(self, path, postdata = None, headers = {}):
@@ -115,9 +1621,27 @@ class Connector(object):
             raise RuntimeError('Not a JSON object')
 
 
-    def _pull_recursive(self, path, destination, keep, base_path = None):
-        try:
+    def _ls_raw(self, path):
+        if self._listing_cache is None:
+            return self._fetch_json('/api/ls' + path)
+        response = self._listing_cache.get(path)
+        if response is None:
             response = self._fetch_json('/api/ls' + path)
+            self._listing_cache.put(path, response)
+        return response
+
+
+    def _invalidate(self, path):
+        if self._listing_cache is not None:
+            self._listing_cache.invalidate(path)
+
+
+    def _pull_recursive(self, pool, path, destination, keep, resume, checksums, base_path = None, item = None):
+        try:
+            if item is None or item['isDir']:
+                response = self._ls_raw(path)
+            else:
+                response = item
         except HTTPError as err:
             raise RuntimeError("Unable to access to '{}'".format(path))
         try:
@@ -132,71 +1656,377 @@ class Connector(object):
                     self._log(localpath + '/')
                     os.makedirs(local_dir_path)
                 for item in response['content']:
-                    self._pull_recursive(path + '/' + item['name'], destination, keep, base_path)
+                    pool.submit(self._pull_recursive, pool, path + '/' + item['name'], destination, keep, resume,
+                                checksums, base_path, item)
             else:
-                local_file_path = os.path.join(destination, localpath)
-                if not keep or not os.path.exists(local_file_path):
-                    response = self._urlopen('/api/fs' + path)
-                    self._log(localpath)
-                    with open(local_file_path, 'wb') as f:
-                        buffer_size = 64 * 1024
-                        while True:
-                            buffer = response.read(buffer_size)
-                            f.write(buffer)
-                            if len(buffer) != buffer_size:
-                                break
+                self._pull_file(path, response, os.path.join(destination, localpath), localpath, keep, resume,
+                                checksums)
+        except HTTPError as err:
+            raise RuntimeError("Unable to access to '{}'".format(path))
+
+
+    def _pull_file(self, path, item, local_file_path, localpath, keep, resume, checksums):
+        offset = None
+        if resume and os.path.exists(local_file_path):
+            local_size = os.path.getsize(local_file_path)
+            if local_size < item['size']:
+                offset = local_size
+            elif local_size > item['size']:
+                offset = 0
+        elif not keep or not os.path.exists(local_file_path):
+            offset = 0
+        if offset is not None:
+            hasher = checksums.new_hasher() if checksums is not None else None
+            size = self._download_file(path, local_file_path, localpath, offset, hasher, item)
+            if checksums is not None:
+                checksums.record(localpath, size, hasher.hexdigest(), _remote_signature(item))
+
+
+    def _journal(self, direction, source, destination, directory):
+        import hashlib
+        transfer = { 'direction': direction, 'device': self.base_url, 'source': source, 'destination': destination }
+        key = json.dumps(transfer, sort_keys = True).encode('utf-8')
+        name = _JOURNAL_PREFIX + hashlib.sha1(key).hexdigest()[:12] + '.json'
+        return _TransferJournal(os.path.join(directory, name), transfer)
+
+
+    def _pull_journaled(self, path, destination, keep, jobs, resume, checksums, continue_journal, response = None):
+        """Pulls a remote directory with a journal of the planned and the completed files.
+        Journal items are [ relpath, remote signature ] lists, with a None signature for directories.
+        If set, response is the listing of path.
+        """
+        path = _normalize_remote_path(path)
+        base_path = posixpath.dirname(path)
+        journal = self._journal('pull', path, os.path.abspath(destination), destination)
+        if continue_journal:
+            journal.load()
+        else:
+            items = []
+            for dirpath, content in self._walk(path, jobs, response = response):
+                relpath = dirpath[len(base_path):].strip('/')
+                items.append([ relpath + '/', None ])
+                items += [ [ relpath + '/' + item['name'], _remote_signature(item) ]
+                           for item in content if not item['isDir'] ]
+            if not os.path.isdir(destination):
+                os.makedirs(destination)
+            journal.create(items)
+        try:
+            with self._transfer.pool(jobs) as pool:
+                for index, (relpath, signature) in enumerate(journal.items):
+                    if signature is None:
+                        if not os.path.isdir(os.path.join(destination, relpath)):
+                            self._log(relpath)
+                            os.makedirs(os.path.join(destination, relpath), exist_ok = True)
+                    elif index not in journal.done:
+                        pool.submit(self._pull_journaled_file, journal, index, base_path + '/' + relpath,
+                                    dict(signature, isDir = False), destination, relpath, keep, resume, checksums)
         except HTTPError as err:
+            journal.close()
             raise RuntimeError("Unable to access to '{}'".format(path))
+        except BaseException:
+            journal.close()
+            raise
+        journal.close(remove = True)
+
+
+    def _pull_journaled_file(self, journal, index, path, item, destination, relpath, keep, resume, checksums):
+        local_file_path = os.path.join(destination, relpath)
+        if os.path.exists(local_file_path) and os.path.getmtime(local_file_path) >= journal.start - 1:
+            # Written by the interrupted transfer, but not completed
+            keep = resume = False
+        self._pull_file(path, item, local_file_path, relpath, keep, resume, checksums)
+        journal.complete(index)
+
+
+    def _download_file(self, path, local_file_path, log_path, offset = 0, hasher = None, item = None):
+        """Downloads a file. If offset is not 0, the download resumes at this position of the local file,
+        or restarts from the beginning if the device doesn't support ranges.
+        If item, the listing of the remote file, is given, the content cache is used.
+        Returns the size of the local file.
+        """
+        cache = self._content_cache if item is not None else None
+        if cache is not None:
+            cached = cache.open(self.base_url, path, item)
+            if cached is not None:
+                self._log(log_path)
+                with cached, open(local_file_path, 'wb') as f:
+                    return _copy_stream(cached, f, self.chunk_size, hasher)
+        if offset > 0:
+            response = self._urlopen('/api/fs' + path, None, { 'Range': 'bytes={}-'.format(offset) })
+            content_range = response.info()['Content-Range'] or ''
+            if response.status != 206 or not content_range.startswith('bytes {}-'.format(offset)):
+                offset = 0
+        else:
+            response = self._urlopen('/api/fs' + path)
+        if cache is not None and offset == 0:
+            # Only whole files are cached, while they are downloaded
+            response = cache.reader(self.base_url, path, item, response)
+        self._log(log_path)
+        start, start_time = time.time(), _clock()
+        try:
+            with open(local_file_path, 'r+b' if offset > 0 else 'wb') as f:
+                if hasher is not None and offset > 0:
+                    # The data already downloaded has to be hashed too
+                    remaining = offset
+                    while remaining > 0:
+                        data = f.read(min(remaining, self.chunk_size))
+                        if len(data) == 0:
+                            break
+                        hasher.update(data)
+                        remaining -= len(data)
+                f.seek(offset)
+                f.truncate()
+                size = _copy_stream(response, f, self.chunk_size, hasher, self._controller())
+        except BaseException:
+            response.close()
+            raise
+        self._emit({ 'type': 'file', 'direction': 'download', 'path': path, 'start': start, 'bytes': size,
+                     'duration': _clock() - start_time })
+        return offset + size
+
+
+    def _upload_file(self, localpath, remotepath, checksums = None, relpath = None, progress = None):
+        size = os.stat(localpath).st_size
+        with open(localpath, 'rb') as f:
+            self._log(remotepath)
+            if checksums is not None:
+                body = _HashingReader(f, checksums.algorithm)
+            elif not self._transfer.active:
+                # Hashing and controlled transfers need to read the data, others don't
+                body = _FileBody(f, size, (lambda sent, total: progress(remotepath, sent, total)) if progress else None)
+            else:
+                body = f
+            self._upload_body(remotepath, body, size)
+            if checksums is not None:
+                checksums.add_pending(remotepath, relpath, size, body.hasher.hexdigest())
+            if progress is not None and not isinstance(body, _FileBody):
+                progress(remotepath, size, size)
+
 
+    def _controller(self):
+        return self._transfer if self._transfer.active else None
 
-    def _push_recursive(self, path, destination, keep, base_path = None):
-        def upload_file(localpath, remotepath):
-            size = os.stat(localpath).st_size
-            with open(localpath, 'rb') as f:
-                self._log(remotepath)
-                self._urlopen('/api/fs' + remotepath, f, { 'Content-Length': size }).read()
 
+    def _upload_body(self, remotepath, body, size):
+        start, start_time = time.time(), _clock()
+        if self._transfer.active:
+            body = self._transfer.wrap(body)
+        try:
+            self._urlopen('/api/fs' + remotepath, body, { 'Content-Length': size }).read()
+        finally:
+            self._invalidate(remotepath)
+        self._emit({ 'type': 'file', 'direction': 'upload', 'path': remotepath, 'start': start, 'bytes': size,
+                     'duration': _clock() - start_time })
+
+
+    def _verify_uploads(self, remote_dir, uploads, checksums):
+        items = dict((item['name'], item) for item in self.ls(remote_dir))
+        for remote_path, relpath, size, digest in uploads:
+            item = items.get(remote_path.rsplit('/', 1)[1])
+            if item is None:
+                checksums.fail(relpath, 'missing on the device')
+            else:
+                checksums.record(relpath, size, digest, _remote_signature(item))
+
+
+    def _push_directory(self, pool, root, dirs, files, remotepath, keep, base_path, checksums, progress):
+        content = []
+        remote_dir_exists = False
+        if keep:
+            try:
+                content = list(map(lambda item: item['name'], self.ls(remotepath)))
+                remote_dir_exists = True
+            except:
+                pass
+        if remotepath[0] == '/':
+            remotepath = remotepath[1:]
+        if len(files) == 0 and len(dirs) == 0 and not remote_dir_exists:
+            self._log('/' + remotepath + '/')
+            self.mkdir(remotepath)
+        else:
+            for filename in files:
+                if not filename in content:
+                    localpath = os.path.join(root, filename)
+                    relpath = os.path.relpath(localpath, base_path).replace(os.sep, '/')
+                    pool.submit(self._upload_file, localpath, '/' + remotepath + '/' + filename, checksums, relpath,
+                                progress)
+
+
+    def _push_recursive(self, path, destination, keep, jobs = 1, checksums = None, progress = None):
         try:
             path = os.path.abspath(path)
-            if os.path.isdir(path):
-                if base_path is None:
-                    base_path = os.path.split(path)[0]
-                for root, dirs, files in os.walk(path):
-                    remotepath = destination + root[len(base_path):]
-                    content = []
-                    remote_dir_exists = False
+            base_path = os.path.split(path)[0]
+            with self._transfer.pool(jobs) as pool:
+                if os.path.isdir(path):
+                    for root, dirs, files in os.walk(path):
+                        remotepath = destination + root[len(base_path):]
+                        pool.submit(self._push_directory, pool, root, dirs, files, remotepath, keep, base_path,
+                                    checksums, progress)
+                else:
+                    remote_file_exists = False
+                    dest_path = destination + '/' + os.path.split(path)[1]
                     if keep:
                         try:
-                            content = list(map(lambda item: item['name'], self.ls(remotepath)))
-                            remote_dir_exists = True
+                            self.ls(dest_path)
                         except:
-                            pass
-                    if remotepath[0] == '/':
-                        remotepath = remotepath[1:]
-                    if len(files) == 0 and len(dirs) == 0 and not remote_dir_exists:
-                        self._log('/' + remotepath + '/')
-                        self.mkdir(remotepath)
+                            remote_file_exists = True
+                    if not keep or remote_file_exists:
+                        self._upload_file(path, dest_path, checksums, os.path.split(path)[1], progress)
+            self._verify_pending_uploads(checksums, jobs)
+        except HTTPError as err:
+            raise RuntimeError("Unable to upload to '{}'\n".format(destination))
+
+
+    def _verify_pending_uploads(self, checksums, jobs):
+        if checksums is None:
+            return
+        uploads_by_dir = {}
+        for upload in checksums.pop_pending():
+            uploads_by_dir.setdefault(upload[0].rsplit('/', 1)[0], []).append(upload)
+        with _WorkerPool(jobs) as pool:
+            for remote_dir, uploads in uploads_by_dir.items():
+                pool.submit(self._verify_uploads, remote_dir, uploads, checksums)
+
+
+    def _push_journaled(self, path, destination, keep, jobs, checksums, progress, continue_journal):
+        """Pushes a local directory with a journal of the planned and the completed items.
+        Journal items are [ relpath, size ] lists, with a None size for empty directories.
+        """
+        path = os.path.abspath(path)
+        base_path = os.path.split(path)[0]
+        destination = _normalize_remote_path(destination)
+        journal = self._journal('push', path, destination, base_path)
+        if continue_journal:
+            journal.load()
+        else:
+            items = []
+            for root, dirs, files in os.walk(path):
+                relpath = os.path.relpath(root, base_path).replace(os.sep, '/')
+                if len(dirs) == 0 and len(files) == 0:
+                    items.append([ relpath + '/', None ])
+                items += [ [ relpath + '/' + filename, os.path.getsize(os.path.join(root, filename)) ]
+                           for filename in files ]
+            journal.create(items)
+        try:
+            with self._transfer.pool(jobs) as pool:
+                files_by_dir = OrderedDict()
+                for index, (relpath, size) in enumerate(journal.items):
+                    if index in journal.done:
+                        continue
+                    if size is None:
+                        pool.submit(self._push_journaled_dir, journal, index, destination + '/' + relpath.rstrip('/'))
                     else:
-                        for filename in files:
-                            if not filename in content:
-                                upload_file(os.path.join(root, filename), '/' + remotepath + '/' + filename)
+                        files_by_dir.setdefault(posixpath.dirname(relpath), []).append(index)
+                for reldir, indices in files_by_dir.items():
+                    # Files not completed by an interrupted transfer may be partial on the device
+                    pool.submit(self._push_journaled_files, pool, journal, indices, base_path, destination,
+                                keep and not continue_journal, checksums, progress)
+            self._verify_pending_uploads(checksums, jobs)
+        except HTTPError as err:
+            journal.close()
+            raise RuntimeError("Unable to upload to '{}'".format(destination))
+        except BaseException:
+            journal.close()
+            raise
+        journal.close(remove = True)
+
+
+    def _push_journaled_dir(self, journal, index, remotepath):
+        self._log(remotepath + '/')
+        self.mkdir(remotepath)
+        journal.complete(index)
+
+
+    def _push_journaled_files(self, pool, journal, indices, base_path, destination, keep, checksums, progress):
+        remote_dir = destination + '/' + posixpath.dirname(journal.items[indices[0]][0])
+        existing = set()
+        if keep:
+            try:
+                existing = set(item['name'] for item in self.ls(remote_dir))
+            except RuntimeError:
+                pass
+        for index in indices:
+            relpath = journal.items[index][0]
+            if posixpath.basename(relpath) in existing:
+                journal.complete(index)
             else:
-                remote_file_exists = False
-                dest_path = destination + '/' + os.path.split(path)[1]
-                if keep:
-                    try:
-                        self.ls(dest_path)
-                    except:
-                        remote_file_exists = True
-                if not keep or remote_file_exists:
-                    upload_file(path, dest_path)
+                pool.submit(self._push_journaled_file, journal, index, os.path.join(base_path, relpath),
+                            destination + '/' + relpath, relpath, checksums, progress)
+
+
+    def _push_journaled_file(self, journal, index, localpath, remotepath, relpath, checksums, progress):
+        self._upload_file(localpath, remotepath, checksums, relpath, progress)
+        journal.complete(index)
+
+
+    def _list_tree(self, pool, path, relpath, files, dirs):
+        response = self._fetch_json('/api/ls' + path)
+        if not response['isDir']:
+            raise RuntimeError("'{}' is not a directory".format(path))
+        for item in response['content']:
+            item_relpath = relpath + item['name']
+            if item['isDir']:
+                dirs.add(item_relpath)
+                pool.submit(self._list_tree, pool, path + '/' + item['name'], item_relpath + '/', files, dirs)
+            else:
+                files[item_relpath] = _remote_signature(item)
+
+
+    def _sync_file(self, path, local_path, relpath, direction, remote, entries):
+        remote_path = path + '/' + relpath
+        local_file_path = os.path.join(local_path, *relpath.split('/'))
+        if direction == 'pull':
+            local_dir_path = os.path.dirname(local_file_path)
+            if not os.path.isdir(local_dir_path):
+                os.makedirs(local_dir_path)
+            self._download_file(remote_path, local_file_path, relpath)
+            entries[relpath] = { 'remote': remote, 'local': _local_signature(local_file_path) }
+        else:
+            local = _local_signature(local_file_path)
+            self._upload_file(local_file_path, remote_path)
+            remote = _remote_signature(self.ls(remote_path)[0])
+            entries[relpath] = { 'remote': remote, 'local': local }
+
+
+    def _delete(self, basedir, items):
+        paths = [ basedir.rstrip('/') + '/' + item for item in items ]
+        try:
+            postdata = codecs.encode(json.dumps({ 'baseDir': basedir, 'items': items }), 'utf-8')
+            self._urlopen('/api/fileops/delete', postdata).read()
         except HTTPError as err:
-            raise RuntimeError("Unable to upload to '{}'\n".format(destination))
+            raise RuntimeError("Unable to delete '{}'".format("', '".join(paths)))
+        finally:
+            for path in paths:
+                self._invalidate(path)
 
 
     # == Public API ===========================================================
 
 
+    def close(self):
+        """Closes the idle connections kept open to the device and saves the listing cache"""
+        self._client.close()
+        if self._listing_cache is not None:
+            self._listing_cache.save()
+
+
+    def stats(self):
+        """Returns a dict of statistics aggregated over the requests and file transfers done so far:
+        numbers of 'requests', HTTP 'errors', 'connections' opened and authentication 'challenges',
+        cumulated seconds spent in each request phase ('connect', 'auth', 'ttfb', 'transfer'), bytes
+        'received' and 'sent', transferred 'files' with their 'file_bytes' and 'file_time', and the
+        'elapsed' seconds between the start of the first event and the end of the last one.
+        """
+        return self._stats.summary()
+
+
+    def invalidate_cache(self, path = None):
+        """Drops cached listings of path, its ancestors and descendants, or the whole cache if path is None.
+        Must be called when files are changed on the device by another mean than this Connector.
+        """
+        self._invalidate(path)
+
+
     def info(self):
         """Returns a dict with information on the device (name, paths, ...)"""
         return self._fetch_json('/api/info')
@@ -205,7 +2035,7 @@ class Connector(object):
     def ls(self, path):
         """Returns a list of dics with information on a filesystem entry"""
         try:
-            response = self._fetch_json('/api/ls' + path)
+            response = self._ls_raw(path)
             if 'content' in response:
                 return response['content']
             else:
@@ -214,6 +2044,81 @@ class Connector(object):
             raise RuntimeError("Unable to access to '{}'".format(path))
 
 
+    def walk(self, path, jobs = 4, prefetch = 32, onerror = None):
+        """Walks a remote directory tree, depth first, and yields a `(dirpath, items)` tuple for each
+        directory, with `items` the list of dicts describing its content as returned by `ls`.
+        Listings of the next directories are fetched in the background while the previous ones are
+        processed, and at most `prefetch` of them are kept in memory ahead of the iteration.
+
+        Args:
+            path (str): the remote directory to walk
+            jobs (int): number of concurrent listing requests
+            prefetch (int): maximum number of directory listings fetched ahead
+            onerror (function, optional): a function called with a RuntimeError for each subdirectory
+                which can't be listed, the subdirectory is then skipped. By default the error is raised
+        """
+        return self._walk(path, jobs, prefetch, onerror)
+
+
+    def _walk(self, path, jobs = 4, prefetch = 32, onerror = None, response = None):
+        """Implements `walk`. If response is set, it is the listing of path, which isn't fetched again"""
+        import threading
+        root = _normalize_remote_path(path)
+        listings = {}
+        condition = threading.Condition()
+
+        def fetch(dirpath):
+            try:
+                listing = (self._ls_raw(dirpath), None)
+            except HTTPError as err:
+                listing = (None, RuntimeError("Unable to access to '{}'".format(dirpath)))
+            except Exception as err:
+                listing = (None, err)
+            with condition:
+                listings[dirpath] = listing
+                condition.notify_all()
+
+        # Directories to yield, the next one last, and directories whose listing has been requested
+        stack = [ root ]
+        requested = set()
+        if response is not None:
+            listings[root] = (response, None)
+            requested.add(root)
+
+        def request_next(pool):
+            # Without concurrency, listings are fetched when they are needed
+            limit = max(1, prefetch) if pool.jobs > 1 else 1
+            for dirpath in reversed(stack):
+                if len(requested) >= limit:
+                    break
+                if dirpath not in requested:
+                    requested.add(dirpath)
+                    pool.submit(fetch, dirpath)
+
+        with _WorkerPool(jobs) as pool:
+            while stack:
+                request_next(pool)
+                dirpath = stack.pop()
+                with condition:
+                    while dirpath not in listings:
+                        # A timeout keeps the main thread responsive to KeyboardInterrupt
+                        condition.wait(0.5)
+                    response, error = listings.pop(dirpath)
+                requested.discard(dirpath)
+                if error is None and not response['isDir']:
+                    error = RuntimeError("'{}' is not a directory".format(dirpath))
+                if error is not None:
+                    if onerror is None or dirpath == root or not isinstance(error, RuntimeError):
+                        raise error
+                    onerror(error)
+                    continue
+                items = response['content']
+                stack.extend(reversed([ dirpath.rstrip('/') + '/' + item['name'] for item in items if item['isDir'] ]))
+                if pool.jobs > 1:
+                    request_next(pool)
+                yield dirpath, items
+
+
     def mkdir(self, path):
         """Creates a new directory.
         Missing intermediate paths are created.
@@ -223,18 +2128,53 @@ class Connector(object):
             self._urlopen('/api/fileops/mkdir', postdata).read()
         except HTTPError as err:
             raise RuntimeError("Unable to create '{}'".format(path))
+        finally:
+            self._invalidate(path)
+
+
+    def mkdir_many(self, paths, jobs = 1):
+        """Creates several directories.
+        Missing intermediate paths are created, so no request is sent for the paths which are
+        ancestors of other ones.
+
+        Args:
+            paths (list): Absolute remote paths of the directories
+            jobs (int): maximum number of concurrent requests
+        """
+        paths = set(_normalize_remote_path(path) for path in paths)
+        ancestors = set()
+        for path in paths:
+            ancestors.update(_remote_ancestors(path))
+        with _WorkerPool(jobs) as pool:
+            for path in sorted(paths - ancestors):
+                pool.submit(self.mkdir, path)
 
 
     def rm(self, path):
         """Deletes a file or diectory
         If path is a direcrory, its content is recursively deleted
         """
-        try:
-            basedir, item = os.path.split(path)
-            postdata = codecs.encode(json.dumps({ 'baseDir': basedir, 'items': [ item ] }), 'utf-8')
-            self._urlopen('/api/fileops/delete', postdata).read()
-        except HTTPError as err:
-            raise RuntimeError("Unable to delete '{}'".format(path))
+        self.rm_many([ path ])
+
+
+    def rm_many(self, paths, jobs = 1):
+        """Deletes several files or directories
+        Paths are grouped by parent directory, so that a single request is sent for each parent directory.
+        Paths inside directories which are deleted too are ignored.
+
+        Args:
+            paths (list): Absolute remote paths of the files and directories
+            jobs (int): maximum number of concurrent requests
+        """
+        paths = set(_normalize_remote_path(path) for path in paths)
+        groups = OrderedDict()
+        for path in sorted(paths):
+            if not any(ancestor in paths for ancestor in _remote_ancestors(path)):
+                basedir, item = os.path.split(path)
+                groups.setdefault(basedir, []).append(item)
+        with _WorkerPool(jobs) as pool:
+            for basedir, items in groups.items():
+                pool.submit(self._delete, basedir, items)
 
 
     def mv(self, src_path, dst_path):
@@ -247,36 +2187,301 @@ class Connector(object):
             self._urlopen('/api/fileops/move', postdata).read()
         except HTTPError as err:
             raise RuntimeError("Unable to move '{}' to '{}'".format(src_path, dst_path))
+        finally:
+            self._invalidate(src_path)
+            self._invalidate(dst_path)
 
 
-    def cat(self, path):
-        """Returns a file-like object with the content of the file at path"""
+    def mv_many(self, src_paths, dst_path, jobs = 1):
+        """Moves several files or directories to a directory
+        The device only moves one path per request: requests are pipelined over persistent connections,
+        up to `jobs` at the same time.
+
+        Args:
+            src_paths (list): Absolute remote paths of the files and directories to move
+            dst_path (str): Absolute remote path of the destination directory
+            jobs (int): maximum number of concurrent requests
+        """
+        with _WorkerPool(jobs) as pool:
+            for src_path in src_paths:
+                pool.submit(self.mv, src_path, dst_path)
+
+
+    def cat(self, path, offset = 0, length = None):
+        """Returns a file-like object with the content of the file at path
+
+        Args:
+            path (str): Absolute remote path of a file
+            offset (int): position of the first byte to read, negative values are relative to the end of the file
+            length (int, optional): maximum number of bytes to read, None to read until the end of the file
+        """
         try:
-            return self._urlopen('/api/fs' + path)
+            if offset == 0 and length is None:
+                if self._content_cache is not None:
+                    # Ranges are read from the device, without listing the file first
+                    item = self._ls_raw(path)
+                    if not item['isDir']:
+                        cached = self._content_cache.open(self.base_url, path, item)
+                        if cached is not None:
+                            return cached
+                        return self._content_cache.reader(self.base_url, path, item, self._urlopen('/api/fs' + path))
+                return self._urlopen('/api/fs' + path)
+            if offset < 0:
+                byte_range = 'bytes={}'.format(offset)
+            elif length is None:
+                byte_range = 'bytes={}-'.format(offset)
+            else:
+                byte_range = 'bytes={}-{}'.format(offset, offset + max(length, 1) - 1)
+            response = self._urlopen('/api/fs' + path, None, { 'Range': byte_range })
+            if response.status == 206:
+                return _RangeReader(response, 0, length)
+            # The device ignored the range: skip the beginning of the content
+            if offset < 0:
+                size = response.info()['Content-Length']
+                if size is None:
+                    content = response.read()
+                    return _RangeReader(io.BytesIO(content[offset:]), 0, length)
+                offset = max(0, int(size) + offset)
+            return _RangeReader(response, offset, length)
         except HTTPError as err:
+            if err.code == 416:
+                return io.BytesIO(b'')
             raise RuntimeError("Unable to read '{}'".format(path))
 
 
-    def pull(self, path, destination, keep = True):
+    def download(self, path, fileobj, offset = 0, length = None):
+        """Writes the content of the file at path to a binary file-like object
+
+        Args:
+            path (str): Absolute remote path of a file
+            fileobj: an object with a `write` method accepting memoryviews, like files opened in binary mode
+            offset (int): position of the first byte to read, negative values are relative to the end of the file
+            length (int, optional): maximum number of bytes to read, None to read until the end of the file
+
+        Returns:
+            The number of bytes written
+        """
+        with self.cat(path, offset, length) as response:
+            return _copy_stream(response, fileobj, self.chunk_size, controller = self._controller())
+
+
+    def pull(self, path, destination, keep = True, jobs = 1, resume = False, checksum = None, journal = False,
+             continue_journal = False):
         """Copies a file or directory from the device to the local path
 
         Args:
             path (str): Absolute remote path of a file or directory to download
             destination (str): Local destination path
             keep (bool): if true, existing local files are preserved
+            jobs (int): maximum number of concurrent requests used to list directories and download files
+            resume (bool): if true, local files smaller than the remote ones are considered as partial downloads
+                and completed, local files having the same size are preserved
+            checksum (str, optional): a hashlib algorithm name (ex: 'sha256'). If set, downloaded files are
+                hashed while they are written and recorded in a `.sweech-checksums.json` file in destination.
+                Their size is checked against the remote size, and their checksum against the previous one
+                recorded for the same remote file. RuntimeError is raised if some files fail the verification.
+            journal (bool): if true and path is a directory, its whole tree is listed first, and the files to
+                download and the completed ones are recorded in a `.sweech-journal-*.json` file in destination
+                as the transfer progresses. The journal is removed once the transfer is done. If it can't be
+                written, the transfer goes on without journal.
+            continue_journal (bool): if true, the transfer recorded in the journal of an interrupted pull of
+                the same path to the same destination is continued, without listing the tree again. Files
+                written by the interrupted transfer but not completed are downloaded again.
+                RuntimeError is raised if there is no such journal.
         """
-        self._pull_recursive(path, destination, keep)
+        checksums = _ChecksumManifest(checksum, destination) if checksum else None
+        response = None
+        if journal and not continue_journal:
+            try:
+                response = self._ls_raw(path)
+            except HTTPError as err:
+                raise RuntimeError("Unable to access to '{}'".format(path))
+        if continue_journal or (response is not None and response['isDir']):
+            self._pull_journaled(path, destination, keep, jobs, resume, checksums, continue_journal, response)
+        else:
+            # The listing of a file describes it, it isn't fetched again
+            with self._transfer.pool(jobs) as pool:
+                pool.submit(self._pull_recursive, pool, path, destination, keep, resume, checksums, None, response)
+        if checksums is not None:
+            checksums.save()
 
 
-    def push(self, path, destination, keep = True):
+    def push(self, path, destination, keep = True, jobs = 1, checksum = None, progress = None, journal = False,
+             continue_journal = False):
         """Copies a file or directory to the device
 
         Args:
             path (str): Local path of a file or directory to upload
             destination (str): Absolute remote destination path
             keep (bool): if true, existing remote files are preserved
+            jobs (int): maximum number of concurrent requests used to create directories and upload files
+            checksum (str, optional): a hashlib algorithm name (ex: 'sha256'). If set, uploaded files are
+                hashed while they are read and recorded in a `.sweech-checksums.json` file in the directory
+                containing path. The remote size of uploaded files is checked once they are uploaded.
+                RuntimeError is raised if some files fail the verification.
+            progress (function, optional): called with the remote path, the number of bytes sent and the
+                size of each uploaded file, as the upload progresses (see `upload`)
+            journal (bool): if true and path is a directory, the items to upload and the completed ones are
+                recorded in a `.sweech-journal-*.json` file in the directory containing path as the transfer
+                progresses. The journal is removed once the transfer is done. If it can't be written, the
+                transfer goes on without journal.
+            continue_journal (bool): if true, the transfer recorded in the journal of an interrupted push of
+                the same path to the same destination is continued, without walking the local tree and listing
+                remote directories again. Files not completed by the interrupted transfer are uploaded again.
+                RuntimeError is raised if there is no such journal.
+        """
+        base_dir = os.path.split(os.path.abspath(path))[0]
+        checksums = _ChecksumManifest(checksum, base_dir) if checksum else None
+        if continue_journal or (journal and os.path.isdir(path)):
+            self._push_journaled(path, destination, keep, jobs, checksums, progress, continue_journal)
+        else:
+            self._push_recursive(path, destination, keep, jobs, checksums, progress)
+        if checksums is not None:
+            checksums.save()
+
+
+    def upload(self, localpath, remotepath, progress = None):
+        """Uploads a local file to a remote file path. Unless the transfers are controlled (see the rate_limit
+        and adaptive arguments of Connector), the file is sent without being read by Python: the kernel
+        copies it to the connection on plain HTTP, a memory map of it is written on HTTPS.
+
+        Args:
+            localpath (str): Local path of a file
+            remotepath (str): Absolute remote path of the uploaded file, replaced if it exists
+            progress (function, optional): called with remotepath, the number of bytes sent so far and the
+                size of the file, at least once per MiB sent and when the upload is done
+
+        Returns:
+            The number of bytes uploaded
         """
-        self._push_recursive(path, destination, keep)
+        remotepath = _normalize_remote_path(remotepath)
+        try:
+            self._upload_file(localpath, remotepath, progress = progress)
+        except HTTPError as err:
+            raise RuntimeError("Unable to upload to '{}'".format(remotepath))
+        return os.stat(localpath).st_size
+
+
+    def sync(self, path, local_path, direction = 'pull', jobs = 1, manifest = None):
+        """Synchronizes a remote directory and a local directory, transferring only added and changed files
+
+        The state of both sides after the previous run is kept in a manifest file (sizes and
+        modification times, and the metadata returned by the device for each file). Each run compares
+        a fresh listing of both sides with it to find what has changed since. Deleted files are not
+        propagated. On the first run, files having the same size on both sides are considered identical.
+        Files which fail to be transferred are transferred again by the next run.
+
+        Args:
+            path (str): Absolute remote path of a directory
+            local_path (str): Local directory mirroring the remote one
+            direction (str): 'pull' to update local files, 'push' to update remote files,
+                'both' to propagate changes in both directions. Files changed on both sides are
+                left untouched and reported as conflicts.
+            jobs (int): maximum number of concurrent requests
+            manifest (str, optional): path of the manifest file, by default `.sweech-sync.json` in `local_path`
+
+        Returns:
+            A dict with 'pulled', 'pushed' and 'conflicts' lists of relative paths
+        """
+        if direction not in ('pull', 'push', 'both'):
+            raise ValueError("Invalid sync direction '{}'".format(direction))
+        path = path.rstrip('/')
+        if manifest is None:
+            manifest = os.path.join(local_path, _SYNC_MANIFEST)
+        previous = _load_json_file(manifest) or {}
+        if previous.get('remote') != path:
+            previous = {}
+        previous_entries = previous.get('files', {})
+        if not os.path.isdir(local_path):
+            if direction == 'push':
+                raise RuntimeError("Unable to access to '{}'".format(local_path))
+            os.makedirs(local_path)
+
+        remote_files = {}
+        remote_dirs = set()
+        try:
+            with _WorkerPool(jobs) as pool:
+                pool.submit(self._list_tree, pool, path, '', remote_files, remote_dirs)
+        except HTTPError as err:
+            # A missing remote directory is created by pushes
+            if direction == 'pull' or remote_files or remote_dirs:
+                raise RuntimeError("Unable to access to '{}'".format(path))
+        local_files = {}
+        local_dirs = set()
+        for root, dirs, files in os.walk(local_path):
+            relroot = os.path.relpath(root, local_path).replace(os.sep, '/')
+            relroot = '' if relroot == '.' else relroot + '/'
+            for dirname in dirs:
+                local_dirs.add(relroot + dirname)
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                if os.path.abspath(file_path) != os.path.abspath(manifest):
+                    local_files[relroot + filename] = _local_signature(file_path)
+
+        result = { 'pulled': [], 'pushed': [], 'conflicts': [] }
+        entries = {}
+        transfers = []
+        for relpath in sorted(set(remote_files) | set(local_files)):
+            remote = remote_files.get(relpath)
+            local = local_files.get(relpath)
+            entry = previous_entries.get(relpath)
+            if remote is not None and local is not None and entry is None and not previous \
+               and remote['size'] == local[0]:
+                entry = { 'remote': remote, 'local': local }
+            remote_changed = remote is not None and (entry is None or entry['remote'] != remote)
+            local_changed = local is not None and (entry is None or entry['local'] != local)
+            operation = None
+            if direction == 'pull':
+                if remote is not None and (local is None or remote_changed or local_changed):
+                    operation = 'pull'
+            elif direction == 'push':
+                if local is not None and (remote is None or remote_changed or local_changed):
+                    operation = 'push'
+            elif remote is None:
+                operation = 'push'
+            elif local is None:
+                operation = 'pull'
+            elif remote_changed and local_changed:
+                result['conflicts'].append(relpath)
+            elif remote_changed:
+                operation = 'pull'
+            elif local_changed:
+                operation = 'push'
+            if operation is None:
+                if entry is not None and remote is not None and local is not None:
+                    entries[relpath] = entry
+            else:
+                transfers.append((relpath, operation, remote))
+
+        try:
+            with _WorkerPool(jobs) as pool:
+                if direction != 'push':
+                    for relpath in sorted(remote_dirs - local_dirs):
+                        os.makedirs(os.path.join(local_path, *relpath.split('/')))
+                if direction != 'pull':
+                    for relpath in sorted(local_dirs - remote_dirs):
+                        if not any(d.startswith(relpath + '/') for d in local_dirs) and \
+                           not any(f.startswith(relpath + '/') for f in local_files):
+                            self._log(path + '/' + relpath + '/')
+                            pool.submit(self.mkdir, path + '/' + relpath)
+                for relpath, operation, remote in transfers:
+                    result[operation + 'ed'].append(relpath)
+                    pool.submit(self._sync_file, path, local_path, relpath, operation, remote, entries)
+        except HTTPError as err:
+            raise RuntimeError("Unable to synchronize '{}'".format(path))
+        finally:
+            for relpath, operation, remote in transfers:
+                if relpath not in entries:
+                    # Failed or cancelled: the source side is marked as changed, so that the next run transfers
+                    # the file again
+                    local_file_path = os.path.join(local_path, *relpath.split('/'))
+                    if operation == 'pull':
+                        local = _local_signature(local_file_path) if os.path.exists(local_file_path) else None
+                        entries[relpath] = { 'remote': None, 'local': local }
+                    else:
+                        entries[relpath] = { 'remote': remote, 'local': None }
+            _save_json_file(manifest, { 'version': 1, 'remote': path, 'files': entries })
+        return result
 
 
     def clipboard(self, text = None):
@@ -294,9 +2499,811 @@ class Connector(object):
             self._urlopen('/api/clipboard', postdata).read()
 
 
+    def watch_clipboard(self, min_interval = 0.5, max_interval = 5.0, local_clipboard = None):
+        """Polls the clipboard content and yields it when it changes, starting with the current content.
+        The clipboard is polled every min_interval seconds after a change, and the interval grows up
+        to max_interval while it doesn't change. Contents are compared by hash, only changes are yielded.
+
+        Args:
+            min_interval (float): seconds between two polls after a change
+            max_interval (float): maximum seconds between two polls
+            local_clipboard (optional): an object with `get()` and `set(text)` methods accessing another
+                clipboard, kept in sync with the Android clipboard in both directions. Changes made on
+                either side are yielded.
+        """
+        import hashlib
+
+        def digest(text):
+            return hashlib.sha1(text.encode('utf-8')).digest()
+
+        current = None
+        local = None
+        interval = min_interval
+        while True:
+            text = self.clipboard()
+            changed = digest(text) != current
+            if changed:
+                current = digest(text)
+                if local_clipboard is not None:
+                    local_clipboard.set(text)
+                    local = current
+            elif local_clipboard is not None:
+                text = local_clipboard.get()
+                if digest(text) != local:
+                    local = digest(text)
+                    if local != current:
+                        self.clipboard(text)
+                        current = local
+                        changed = True
+            if changed:
+                interval = min_interval
+                yield text
+            else:
+                interval = min(max_interval, interval * 1.5)
+            time.sleep(interval)
+
+
+# == Multiple devices access ==================================================
+
+
+class MultiConnector(object):
+    """Transfers files to or from several Android devices running Sweech at once"""
+
+    def __init__(self, base_urls, user = None, password = None, log_function = None, **kwargs):
+        """
+        Args:
+            base_urls (list): the URLs displayed in the Sweech app of each device
+            user (str, optional): the username, the same for all devices
+            password (str, optional): the password, the same for all devices
+            log_function (function, optional): a function to call to log file transfers, messages are
+                prefixed with the name of the device
+            **kwargs: other arguments passed to the `Connector` of each device. The transfers of all the
+                devices together are limited by rate_limit, and tuned together if adaptive is set.
+        """
+        import threading
+        rate_limit = kwargs.pop('rate_limit', None)
+        adaptive = kwargs.pop('adaptive', False)
+        self.base_urls = list(base_urls)
+        self.connectors = []
+        self.names = []
+        log_lock = threading.Lock()
+
+        def log(name, msg):
+            # Connectors serialize their own messages only
+            with log_lock:
+                log_function('[{}] {}'.format(name, msg))
+
+        for base_url in self.base_urls:
+            url = urlparse(base_url)
+            name = url.hostname + ('_{}'.format(url.port) if url.port else '')
+            device_log = (lambda name: lambda msg: log(name, msg))(name) if log_function else None
+            self.connectors.append(Connector(base_url, user, password, device_log, **kwargs))
+            self.names.append(name)
+        self.chunk_size = kwargs.get('chunk_size', 64 * 1024)
+        transfer = _TransferController(self.chunk_size, rate_limit, adaptive)
+        for connector in self.connectors:
+            connector._transfer = transfer
+        self._lock = threading.Lock()
+
+    def close(self):
+        for connector in self.connectors:
+            connector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    # == Internal functions ===================================================
+
+    def _for_each(self, function, connectors):
+        """Calls function with each connector concurrently, and returns the errors by connector"""
+        import threading
+        errors = {}
+
+        def run(connector):
+            try:
+                function(connector)
+            except BaseException as err:
+                # Unexpected errors fail the device too, instead of being lost with the thread
+                errors[connector] = err
+
+        threads = [ threading.Thread(target = run, args = (connector,)) for connector in connectors ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def _start(self):
+        # A first request checks that each device is reachable and gets its authentication challenge,
+        # the upload bodies sent to all devices at once can't be sent again after a challenge
+        errors = self._for_each(lambda connector: connector.info(), self.connectors)
+        return dict((connector, errors.get(connector)) for connector in self.connectors)
+
+    def _alive(self, results, connectors):
+        with self._lock:
+            return [ connector for connector in connectors if results[connector] is None ]
+
+    def _fail(self, results, connector, err):
+        with self._lock:
+            if results[connector] is None:
+                results[connector] = err
+
+    def _results(self, results):
+        return OrderedDict((base_url, results[connector])
+                           for base_url, connector in zip(self.base_urls, self.connectors))
+
+    def _push_directory(self, pool, results, root, dirs, files, remotepath, keep):
+        connectors = self._alive(results, self.connectors)
+        contents = {}
+
+        def list_content(connector):
+            try:
+                contents[connector] = set(item['name'] for item in connector.ls(remotepath))
+            except RuntimeError:
+                contents[connector] = None
+
+        if keep:
+            for connector, err in self._for_each(list_content, connectors).items():
+                self._fail(results, connector, err)
+            connectors = self._alive(results, connectors)
+        if len(files) == 0 and len(dirs) == 0:
+            def mkdir(connector):
+                if contents.get(connector) is None:
+                    connector._log(remotepath + '/')
+                    connector.mkdir(remotepath)
+            for connector, err in self._for_each(mkdir, connectors).items():
+                self._fail(results, connector, err)
+            return
+        for filename in files:
+            targets = [ connector for connector in connectors if filename not in (contents.get(connector) or ()) ]
+            if targets:
+                pool.submit(self._push_file, results, os.path.join(root, filename), remotepath + '/' + filename,
+                            targets)
+
+    def _push_file(self, results, localpath, remotepath, connectors):
+        import threading
+        connectors = self._alive(results, connectors)
+        if not connectors:
+            return
+        size = os.stat(localpath).st_size
+        with open(localpath, 'rb') as f:
+            fanout = _Fanout(f, len(connectors), self.chunk_size)
+
+            def upload(index, connector):
+                try:
+                    connector._log(remotepath)
+                    try:
+                        connector._upload_body(remotepath, fanout.body(index), size)
+                    except HTTPError as err:
+                        if err.code != 401:
+                            raise
+                        # The nonce of the device went stale and the fanout body can't be sent again:
+                        # the file is sent again to this device alone, now that the challenge is renewed
+                        fanout.abandon(index)
+                        with open(localpath, 'rb') as retry:
+                            connector._upload_body(remotepath, retry, size)
+                except BaseException as err:
+                    # The fanout must not wait for this device anymore, whatever the error
+                    fanout.abandon(index)
+                    if isinstance(err, HTTPError):
+                        err = RuntimeError("Unable to upload to '{}'".format(remotepath))
+                    self._fail(results, connector, err)
+
+            threads = [ threading.Thread(target = upload, args = (index, connector))
+                        for index, connector in enumerate(connectors) ]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            try:
+                fanout.run()
+            finally:
+                for thread in threads:
+                    thread.join()
+
+
+    # == Public API ===========================================================
+
+    def stats(self):
+        """Returns the statistics of all devices added together, see `Connector.stats`"""
+        total = None
+        for connector in self.connectors:
+            stats = connector.stats()
+            if total is None:
+                total = stats
+            else:
+                for key, value in stats.items():
+                    total[key] = max(total[key], value) if key == 'elapsed' else total[key] + value
+        return total
+
+
+    def push(self, path, destination, keep = True, jobs = 1):
+        """Copies a file or directory to all the devices.
+        Each local file is read once and sent to all the devices which need it at the same time.
+        A device which fails is left out of the rest of the transfer.
+
+        Args:
+            path (str): Local path of a file or directory to upload
+            destination (str): Absolute remote destination path, the same on all devices
+            keep (bool): if true, existing remote files are preserved
+            jobs (int): maximum number of files uploaded concurrently (to all devices)
+
+        Returns:
+            An OrderedDict with, for each device URL, None if the transfer succeeded or the error which
+            stopped it.
+        """
+        results = self._start()
+        path = os.path.abspath(path)
+        base_path = os.path.split(path)[0]
+        with _WorkerPool(jobs) as pool:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    remotepath = destination + root[len(base_path):].replace(os.sep, '/')
+                    pool.submit(self._push_directory, pool, results, root, dirs, files, remotepath, keep)
+            else:
+                remotepath = destination + '/' + os.path.split(path)[1]
+                connectors = self._alive(results, self.connectors)
+                if keep:
+                    missing = []
+
+                    def check_missing(connector):
+                        try:
+                            connector.ls(remotepath)
+                        except RuntimeError:
+                            missing.append(connector)
+
+                    for connector, err in self._for_each(check_missing, connectors).items():
+                        self._fail(results, connector, err)
+                    connectors = [ connector for connector in connectors if connector in missing ]
+                pool.submit(self._push_file, results, path, remotepath, connectors)
+        return self._results(results)
+
+
+    def pull(self, path, destination, keep = True, jobs = 1, resume = False):
+        """Copies a file or directory from all the devices at once, into a subdirectory of the local
+        destination per device, named after the device address (ex: '192.168.0.65_4444').
+
+        Args:
+            path (str): Absolute remote path of a file or directory to download, the same on all devices
+            destination (str): Local destination path
+            keep (bool): if true, existing local files are preserved
+            jobs (int): maximum number of concurrent requests to each device
+            resume (bool): if true, partially downloaded files are completed, see `Connector.pull`
+
+        Returns:
+            An OrderedDict with, for each device URL, None if the transfer succeeded or the error which
+            stopped it.
+        """
+        results = self._start()
+        destinations = dict(zip(self.connectors, self.names))
+
+        def pull(connector):
+            device_destination = os.path.join(destination, destinations[connector])
+            if not os.path.isdir(device_destination):
+                os.makedirs(device_destination)
+            connector.pull(path, device_destination, keep, jobs, resume)
+
+        for connector, err in self._for_each(pull, self._alive(results, self.connectors)).items():
+            self._fail(results, connector, err)
+        return self._results(results)
+
+
+# == Asynchronous Sweech access ===============================================
+
+
+class AsyncConnector(object):
+    """An asyncio counterpart of Connector: all its methods, except close, are coroutines.
+    Connections to the device are kept open and reused between requests.
+    """
+
+    def __init__(self, base_url, user = None, password = None, log_function = None, jobs = 4):
+        """
+        Args:
+            base_url (str): the URL displayed in the Sweech app (ex: 'http://192.168.0.65:4444')
+            user (str, optional): the username if login is enabled in the app
+            password (str, optional): the password if login is enabled in the app
+            log_function (function): a function to be called to log runtime information
+            jobs (int): default maximum number of concurrent requests for pull and push
+        """
+        self.base_url = base_url
+        self.jobs = jobs
+        self._log_function = log_function
+        self._client = _AsyncHTTPClient(base_url, user, password)
+
+
+    # == Internal functions ===================================================
+
+
+    def _log(self, msg):
+        if self._log_function:
+            self._log_function(msg)
+
+    async def _urlopen(self, path, postdata = None, headers = {}):
+        return await self._client.request(quote(path.encode('utf-8')), postdata, headers)
+
+
+    async def _fetch_json(self, path, postdata = None, headers = {}):
+        response = await self._urlopen(path, postdata, headers)
+        content = await response.read()
+        if response.getheader('Content-Type') == 'application/json':
+            return json.loads(content.decode('utf-8'))
+        else:
+            raise RuntimeError('Not a JSON object')
+
+
+    async def _run(self, jobs, function, *args):
+        """Runs function and the tasks it submits with at most `jobs` concurrent tasks"""
+        import asyncio
+        queue = asyncio.Queue()
+        errors = []
+
+        def submit(function, *args):
+            queue.put_nowait((function, args))
+
+        async def worker():
+            while True:
+                function, args = await queue.get()
+                try:
+                    if not errors:
+                        await function(submit, *args)
+                except Exception as err:
+                    errors.append(err)
+                finally:
+                    queue.task_done()
+
+        submit(function, *args)
+        workers = [ asyncio.ensure_future(worker()) for i in range(max(1, jobs or self.jobs)) ]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+        if errors:
+            raise errors[0]
+
+
+    async def _pull_recursive(self, submit, path, destination, keep, base_path = None, item = None):
+        try:
+            if item is None or item['isDir']:
+                response = await self._fetch_json('/api/ls' + path)
+            else:
+                response = item
+            if base_path is None:
+                base_path = os.path.split(path)[0]
+            localpath = path[len(base_path):]
+            if localpath[0] == '/':
+                localpath = localpath[1:]
+            if response['isDir']:
+                local_dir_path = os.path.join(destination, localpath)
+                if not os.path.exists(local_dir_path):
+                    self._log(localpath + '/')
+                    os.makedirs(local_dir_path)
+                for item in response['content']:
+                    submit(self._pull_recursive, path + '/' + item['name'], destination, keep, base_path, item)
+            else:
+                local_file_path = os.path.join(destination, localpath)
+                if not keep or not os.path.exists(local_file_path):
+                    response = await self._urlopen('/api/fs' + path)
+                    self._log(localpath)
+                    with open(local_file_path, 'wb') as f:
+                        async for data in response:
+                            f.write(data)
+        except HTTPError as err:
+            raise RuntimeError("Unable to access to '{}'".format(path))
+
+
+    async def _upload_file(self, submit, localpath, remotepath):
+        size = os.stat(localpath).st_size
+        with open(localpath, 'rb') as f:
+            self._log(remotepath)
+            try:
+                await (await self._urlopen('/api/fs' + remotepath, f, { 'Content-Length': size })).read()
+            except HTTPError as err:
+                raise RuntimeError("Unable to upload to '{}'".format(remotepath))
+
+
+    async def _push_directory(self, submit, root, dirs, files, remotepath, keep):
+        content = []
+        remote_dir_exists = False
+        if keep:
+            try:
+                content = [ item['name'] for item in await self.ls(remotepath) ]
+                remote_dir_exists = True
+            except RuntimeError:
+                pass
+        if remotepath[0] == '/':
+            remotepath = remotepath[1:]
+        if len(files) == 0 and len(dirs) == 0 and not remote_dir_exists:
+            self._log('/' + remotepath + '/')
+            await self.mkdir(remotepath)
+        else:
+            for filename in files:
+                if not filename in content:
+                    submit(self._upload_file, os.path.join(root, filename), '/' + remotepath + '/' + filename)
+
+
+    async def _push_recursive(self, submit, path, destination, keep):
+        if os.path.isdir(path):
+            base_path = os.path.split(path)[0]
+            for root, dirs, files in os.walk(path):
+                remotepath = destination + root[len(base_path):]
+                submit(self._push_directory, root, dirs, files, remotepath, keep)
+        else:
+            dest_path = destination + '/' + os.path.split(path)[1]
+            remote_file_missing = True
+            if keep:
+                try:
+                    await self.ls(dest_path)
+                    remote_file_missing = False
+                except RuntimeError:
+                    pass
+            if remote_file_missing:
+                await self._upload_file(submit, path, dest_path)
+
+
+    # == Public API ===========================================================
+
+
+    def close(self):
+        """Closes the idle connections kept open to the device"""
+        self._client.close()
+
+
+    async def info(self):
+        """Returns a dict with information on the device (name, paths, ...)"""
+        return await self._fetch_json('/api/info')
+
+
+    async def ls(self, path):
+        """Returns a list of dics with information on a filesystem entry"""
+        try:
+            response = await self._fetch_json('/api/ls' + path)
+            if 'content' in response:
+                return response['content']
+            else:
+                return [ response ]
+        except HTTPError as err:
+            raise RuntimeError("Unable to access to '{}'".format(path))
+
+
+    async def mkdir(self, path):
+        """Creates a new directory.
+        Missing intermediate paths are created.
+        """
+        try:
+            postdata = codecs.encode(json.dumps({ 'dir': path }), 'utf-8')
+            await (await self._urlopen('/api/fileops/mkdir', postdata)).read()
+        except HTTPError as err:
+            raise RuntimeError("Unable to create '{}'".format(path))
+
+
+    async def rm(self, path):
+        """Deletes a file or diectory
+        If path is a direcrory, its content is recursively deleted
+        """
+        try:
+            basedir, item = os.path.split(path)
+            postdata = codecs.encode(json.dumps({ 'baseDir': basedir, 'items': [ item ] }), 'utf-8')
+            await (await self._urlopen('/api/fileops/delete', postdata)).read()
+        except HTTPError as err:
+            raise RuntimeError("Unable to delete '{}'".format(path))
+
+
+    async def mv(self, src_path, dst_path):
+        """Move a file or directory
+        Moving files between directories may be slow if src_path and dst_path aren't on the same volume.
+        In this case, a copy + delete is done.
+        """
+        try:
+            postdata = codecs.encode(json.dumps({ 'src': src_path, 'dst': dst_path }), 'utf-8')
+            await (await self._urlopen('/api/fileops/move', postdata)).read()
+        except HTTPError as err:
+            raise RuntimeError("Unable to move '{}' to '{}'".format(src_path, dst_path))
+
+
+    async def cat(self, path, offset = 0, length = None):
+        """Returns a response object streaming the content of the file at path.
+        Its `read(n)` coroutine returns up to n bytes, and it can be iterated with `async for`.
+
+        Args:
+            path (str): Absolute remote path of a file
+            offset (int): position of the first byte to read, negative values are relative to the end of the file
+            length (int, optional): maximum number of bytes to read, None to read until the end of the file
+        """
+        try:
+            if offset == 0 and length is None:
+                return await self._urlopen('/api/fs' + path)
+            if offset < 0:
+                byte_range = 'bytes={}'.format(offset)
+            elif length is None:
+                byte_range = 'bytes={}-'.format(offset)
+            else:
+                byte_range = 'bytes={}-{}'.format(offset, offset + max(length, 1) - 1)
+            response = await self._urlopen('/api/fs' + path, None, { 'Range': byte_range })
+            response.limit = length
+            if response.status != 206:
+                # The device ignored the range: skip the beginning of the content
+                size = response.getheader('Content-Length')
+                if offset >= 0:
+                    response.skip = offset
+                elif size is None:
+                    response.tail = -offset
+                else:
+                    response.skip = max(0, int(size) + offset)
+            return response
+        except HTTPError as err:
+            raise RuntimeError("Unable to read '{}'".format(path))
+
+
+    async def pull(self, path, destination, keep = True, jobs = None):
+        """Copies a file or directory from the device to the local path
+
+        Args:
+            path (str): Absolute remote path of a file or directory to download
+            destination (str): Local destination path
+            keep (bool): if true, existing local files are preserved
+            jobs (int, optional): maximum number of concurrent requests, the Connector's default if None
+        """
+        await self._run(jobs, self._pull_recursive, path, destination, keep)
+
+
+    async def push(self, path, destination, keep = True, jobs = None):
+        """Copies a file or directory to the device
+
+        Args:
+            path (str): Local path of a file or directory to upload
+            destination (str): Absolute remote destination path
+            keep (bool): if true, existing remote files are preserved
+            jobs (int, optional): maximum number of concurrent requests, the Connector's default if None
+        """
+        await self._run(jobs, self._push_recursive, os.path.abspath(path), destination, keep)
+
+
+    async def clipboard(self, text = None):
+        """ Gets or sets the clipboard content
+
+        Args:
+            text (str): The text to put in the Android clipboard
+            or None to get the clipboard content
+        """
+        if text == None:
+            response = await self._fetch_json('/api/clipboard')
+            return response['content']
+        else:
+            postdata = codecs.encode(json.dumps({ 'content': text }), 'utf-8')
+            await (await self._urlopen('/api/clipboard', postdata)).read()
+
+
 # == CLI functions ============================================================
 
 
+def _user_dir(name):
+    if sys.platform == 'win32':
+        return os.getenv('LOCALAPPDATA') or os.getenv('APPDATA')
+    return os.path.join(os.getenv('HOME'), name)
+
+
+def _urls(args):
+    """Returns the list of device URLs given by --url options or the `url` entry of the config file"""
+    if args.url is None:
+        return []
+    return [ args.url ] if isinstance(args.url, str) else list(args.url)
+
+
+def _connector(args, log_function = None):
+    import hashlib
+    if getattr(args, 'connector', None) is not None:
+        # Commands of a batch or shell session share the session connector
+        return args.connector
+    urls = _urls(args)
+    if len(urls) > 1:
+        raise RuntimeError("The '{}' command can't be used with several devices".format(args.command))
+    url = urls[0] if urls else None
+    cache_ttl = getattr(args, 'cache_ttl', None) if not getattr(args, 'no_cache', False) else None
+    cache_path = None
+    if cache_ttl:
+        url_hash = hashlib.md5(url.encode('utf-8')).hexdigest()[:12]
+        cache_path = os.path.join(_user_dir('.cache'), 'sweech', 'listings-{}.json'.format(url_hash))
+    args.connector = Connector(url, args.user, args.password, log_function,
+                               cache_ttl = cache_ttl or None, cache_path = cache_path,
+                               event_function = getattr(args, 'trace_writer', None), **_connector_options(args))
+    return args.connector
+
+
+def _multi_connector(args, log_function = None):
+    if args.verify:
+        raise RuntimeError('--verify can\'t be used with several devices')
+    if args.journal or args.continue_journal:
+        raise RuntimeError('--journal and --continue can\'t be used with several devices')
+    args.connector = MultiConnector(_urls(args), args.user, args.password, log_function,
+                                    event_function = getattr(args, 'trace_writer', None), **_connector_options(args))
+    return args.connector
+
+
+def _config_size(args, key, default = None):
+    value = getattr(args, key, None)
+    if isinstance(value, str):
+        # Set in the config file
+        try:
+            return _parse_size(value)
+        except argparse.ArgumentTypeError as err:
+            raise RuntimeError('{}: {}'.format(key, err))
+    return default if value is None else value
+
+
+def _connector_options(args):
+    options = {
+        'rate_limit': _config_size(args, 'limit_rate') or None,
+        'adaptive': bool(getattr(args, 'adaptive', False)),
+    }
+    if getattr(args, 'content_cache', False) and not getattr(args, 'no_cache', False):
+        options['content_cache_path'] = os.path.join(_user_dir('.cache'), 'sweech', 'content')
+        options['content_cache_size'] = _config_size(args, 'content_cache_size', 256 * 1024 * 1024)
+    return options
+
+
+def _report_devices(results):
+    failures = 0
+    for url, err in results.items():
+        if err is not None:
+            sys.stderr.write('{}: {}\n'.format(url, _error_message(err)))
+            failures += 1
+    if failures:
+        raise RuntimeError('The transfer failed on {} of {} devices'.format(failures, len(results)))
+
+
+def _print_stats(stats):
+    elapsed = stats['elapsed']
+    request_time = stats['connect'] + stats['auth'] + stats['ttfb'] + stats['transfer']
+    lines = [
+        'Requests:       {} ({} errors), {} connections opened, {} authentication challenges'.format(
+            stats['requests'], stats['errors'], stats['connections'], stats['challenges']),
+        'Elapsed:        {:.3f}s'.format(elapsed),
+        'Request time:   connect {:.3f}s, auth {:.3f}s, waiting {:.3f}s, transfer {:.3f}s (cumulated)'.format(
+            stats['connect'], stats['auth'], stats['ttfb'], stats['transfer']),
+        'Data:           {} received, {} sent'.format(_pretty_size(stats['received']).strip(),
+                                                      _pretty_size(stats['sent']).strip()),
+        'Files:          {} ({})'.format(stats['files'], _pretty_size(stats['file_bytes']).strip()),
+    ]
+    if elapsed > 0:
+        lines.append('Throughput:     {}/s, {:.1f} requests/s'.format(
+            _pretty_size(int((stats['received'] + stats['sent']) / elapsed)).strip(), stats['requests'] / elapsed))
+    if request_time > 0:
+        lines.append('Latency share:  {:.0f}% of the request time is spent connecting and waiting for responses'.format(
+            100.0 * (request_time - stats['transfer']) / request_time))
+    sys.stderr.write('\n'.join(lines) + '\n')
+
+
+def _error_message(err):
+    if isinstance(err, URLError):
+        return str(err.reason)
+    if isinstance(err, RuntimeError):
+        return str(err.args[0]).rstrip('\n')
+    return str(err)
+
+
+def _load_config():
+    if sys.platform == 'win32':
+        config_path = os.path.join(os.getenv('APPDATA'), 'sweech.json')
+    else:
+        config_path = os.path.join(os.getenv('HOME'), '.config', 'sweech.json')
+    if os.path.exists(config_path):
+        return json.loads(open(config_path).read())
+    return {}
+
+
+def _apply_config(args, config):
+    for key in config.keys():
+        if not hasattr(args, key) or getattr(args, key) is None:
+            setattr(args, key, config[key])
+
+
+class _ThreadOutput(object):
+    """Stands for sys.stdout while batch commands run concurrently.
+    Threads which called `capture` write to their own buffer, the others to the real stdout.
+    """
+
+    def __init__(self, stdout):
+        import threading
+        self._stdout = stdout
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.output = io.TextIOWrapper(io.BytesIO(), encoding = self._stdout.encoding, errors = 'replace')
+
+    def release(self):
+        output = self._local.output
+        del self._local.output
+        output.flush()
+        return output.buffer.getvalue()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, 'output', self._stdout), name)
+
+
+class _Session(object):
+    """Runs commands written with the command line syntax against a single connector.
+    The current directory, initialized to `defaultdir`, is the base of relative remote paths.
+    """
+
+    # Commands which only read the device, and can run concurrently when a batch is pipelined
+    PIPELINED_COMMANDS = ('info', 'ls', 'du', 'find', 'cat', 'pull')
+
+    def __init__(self, args, config):
+        self._args = args
+        self._config = config
+        self.cwd = getattr(args, 'defaultdir', None)
+        self.connector = _connector(args, print)
+        self._parser = argparse.ArgumentParser(prog = 'sweech', add_help = False)
+        _add_commands(self._parser, [ command for command in _COMMANDS if command[0] not in ('batch', 'shell') ])
+
+    def parse(self, argv):
+        """Returns the arguments of a command, or None if it has nothing to run (help requested)"""
+        args = argparse.Namespace(**dict((key, getattr(self._args, key))
+                                         for key in ('url', 'user', 'password', 'cache_ttl')))
+        _apply_config(args, self._config)
+        if self.cwd is not None:
+            args.defaultdir = self.cwd
+        args.connector = self.connector
+        try:
+            self._parser.parse_args(argv, args)
+        except SystemExit as err:
+            if err.code:
+                raise RuntimeError("Invalid command: '{}'".format(' '.join(argv)))
+            return None
+        return args
+
+    def execute(self, argv):
+        if argv[0] == 'cd':
+            self.cd(argv[1] if len(argv) > 1 else None)
+        elif argv[0] == 'pwd':
+            print(self.cwd or '/')
+        else:
+            args = self.parse(argv)
+            if args is not None:
+                self.run(args)
+
+    def run(self, args):
+        getattr(sys.modules[__name__], '_' + args.command)(args)
+
+    def print_help(self):
+        self._parser.print_help()
+        print('\nSession commands: cd [PATH], pwd')
+
+    def cd(self, path):
+        if path is None:
+            self.cwd = getattr(self._args, 'defaultdir', None)
+            return
+        if not path.startswith('/'):
+            if self.cwd is None:
+                raise RuntimeError('No current directory, use an absolute path')
+            path = self.cwd + '/' + path
+        path = posixpath.normpath('/' + path.strip('/'))
+        try:
+            is_dir = self.connector._ls_raw(path)['isDir']
+        except HTTPError:
+            is_dir = False
+        if not is_dir:
+            raise RuntimeError("'{}' is not a directory".format(path))
+        self.cwd = path
+
+
+def _batch_commands(name, lines):
+    """Yields the line number and arguments of each command of a batch"""
+    import shlex
+    for lineno, line in enumerate(lines, 1):
+        try:
+            argv = shlex.split(line, comments = True)
+        except ValueError as err:
+            raise RuntimeError('{}:{}: {}'.format(name, lineno, err))
+        if argv:
+            yield lineno, argv
+
+
 def _info(args):
 
     def print_storage_info(storage):
@@ -307,7 +3314,7 @@ def _info(args):
         print('  Available:    {}'.format(_pretty_size(storage['availableBytes'])))
         print('  Total:        {}'.format(_pretty_size(storage['totalBytes'])))
 
-    inf = Connector(args.url, args.user, args.password).info()
+    inf = _connector(args).info()
     print('Device:           {} {}'.format(inf['brand'], inf['model']))
     print('API:              {}'.format(inf['sdk']))
     print('Internal storage:')
@@ -332,9 +3339,17 @@ def _ls(args):
             args.paths.append(args.defaultdir)
         else:
             raise RuntimeError('Path missing')
-    conn = Connector(args.url, args.user, args.password)
+    conn = _connector(args)
     for i, path in enumerate(args.paths):
         path = _make_abs(args, path)
+        if args.recursive:
+            for j, (dirpath, items) in enumerate(conn.walk(path, args.jobs or 4, onerror = _walk_error)):
+                if i > 0 or j > 0:
+                    print('')
+                print(dirpath + ':')
+                for item in items:
+                    print(_ls_item_to_str(item))
+            continue
         if len(args.paths) > 1:
             if i > 0:
                 print('')
@@ -343,16 +3358,75 @@ def _ls(args):
             print(_ls_item_to_str(item))
 
 
-def _mkdir(args):
-    conn = Connector(args.url, args.user, args.password)
+def _walk_error(err):
+    sys.stderr.write(_error_message(err) + '\n')
+
+
+def _du(args):
+    if len(args.paths) == 0:
+        if hasattr(args, 'defaultdir'):
+            args.paths.append(args.defaultdir)
+        else:
+            raise RuntimeError('Path missing')
+    conn = _connector(args)
     for path in args.paths:
-        conn.mkdir(_make_abs(args, path))
+        # Directories being walked, with the size of their content walked so far
+        opened = []
+
+        def close_directory():
+            dirpath, size = opened.pop()
+            if opened:
+                opened[-1][1] += size
+            if not args.summarize or not opened:
+                print('{}    {}'.format(_pretty_size(size), dirpath))
+
+        for dirpath, items in conn.walk(_make_abs(args, path), args.jobs or 4, onerror = _walk_error):
+            while opened and not dirpath.startswith(opened[-1][0].rstrip('/') + '/'):
+                close_directory()
+            opened.append([ dirpath, sum(item['size'] for item in items if not item['isDir']) ])
+        while opened:
+            close_directory()
+
+
+def _parse_size(text):
+    units = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+    value = text.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(text))
 
 
-def _rm(args):
-    conn = Connector(args.url, args.user, args.password)
+def _find(args):
+    import fnmatch
+    if len(args.paths) == 0:
+        if hasattr(args, 'defaultdir'):
+            args.paths.append(args.defaultdir)
+        else:
+            raise RuntimeError('Path missing')
+    conn = _connector(args)
     for path in args.paths:
-        conn.rm(_make_abs(args, path))
+        for dirpath, items in conn.walk(_make_abs(args, path), args.jobs or 4, onerror = _walk_error):
+            for item in items:
+                if args.type is not None and item['isDir'] != (args.type == 'd'):
+                    continue
+                if args.name is not None and not fnmatch.fnmatch(item['name'], args.name):
+                    continue
+                if args.min_size is not None and (item['isDir'] or item['size'] < args.min_size):
+                    continue
+                print(dirpath.rstrip('/') + '/' + item['name'])
+
+
+def _mkdir(args):
+    conn = _connector(args)
+    conn.mkdir_many([ _make_abs(args, path) for path in args.paths ], args.jobs)
+
+
+def _rm(args):
+    conn = _connector(args)
+    conn.rm_many([ _make_abs(args, path) for path in args.paths ], args.jobs)
 
 
 def _mv(args):
@@ -361,30 +3435,30 @@ def _mv(args):
         args.destination = args.paths.pop()
     else:
         raise RuntimeError('Destination path missing')
-    conn = Connector(args.url, args.user, args.password)
+    conn = _connector(args)
     dst = _make_abs(args, args.destination)
-    for path in args.paths:
-        conn.mv(_make_abs(args, path), dst)
+    conn.mv_many([ _make_abs(args, path) for path in args.paths ], dst, args.jobs)
 
 
 def _cat(args):
-    conn = Connector(args.url, args.user, args.password)
+    conn = _connector(args)
     for path in args.paths:
-        r = conn.cat(_make_abs(args, path))
-        buffer_size = 64 * 1024
-        while True:
-            buffer = r.read(buffer_size)
-            os.write(1, buffer)
-            if len(buffer) != buffer_size:
-                break
+        conn.download(_make_abs(args, path), sys.stdout.buffer, args.offset, args.bytes)
+        sys.stdout.buffer.flush()
 
 
 def _pull(args):
     # Fix destination as argparse cannot handle both '*' and '?' arguments
     args.destination = args.paths.pop() if len(args.paths) > 1 else '.'
-    conn = Connector(args.url, args.user, args.password, print)
+    if len(_urls(args)) > 1:
+        conn = _multi_connector(args, print)
+        for path in args.paths:
+            _report_devices(conn.pull(_make_abs(args, path), args.destination, args.keep, args.jobs, args.resume))
+        return
+    conn = _connector(args, print)
     for path in args.paths:
-        conn.pull(_make_abs(args, path), args.destination, args.keep)
+        conn.pull(_make_abs(args, path), args.destination, args.keep, args.jobs, args.resume, args.verify,
+                  args.journal, args.continue_journal)
 
 
 def _push(args):
@@ -396,68 +3470,371 @@ def _push(args):
             args.destination = args.defaultdir
         else:
             raise RuntimeError('Destination path missing')
-    conn = Connector(args.url, args.user, args.password, print)
+    if len(_urls(args)) > 1:
+        conn = _multi_connector(args, print)
+        for path in args.paths:
+            _report_devices(conn.push(path, _make_abs(args, args.destination), args.keep, args.jobs))
+        return
+    conn = _connector(args, print)
     for path in args.paths:
-        conn.push(path, _make_abs(args, args.destination), args.keep)
+        conn.push(path, _make_abs(args, args.destination), args.keep, args.jobs, args.verify,
+                  journal = args.journal, continue_journal = args.continue_journal)
+
+
+def _sync(args):
+    if args.path is None:
+        if hasattr(args, 'defaultdir'):
+            args.path = args.defaultdir
+        else:
+            raise RuntimeError('Path missing')
+    conn = _connector(args, print)
+    result = conn.sync(_make_abs(args, args.path), args.destination, args.direction, args.jobs)
+    for path in result['conflicts']:
+        sys.stderr.write("Conflict: '{}' has changed on both sides\n".format(path))
+
+
+class _LocalClipboard(object):
+    """Gets and sets the clipboard of this computer with the usual command line tools"""
+
+    COMMANDS = [
+        ([ 'pbpaste' ], [ 'pbcopy' ]),
+        ([ 'wl-paste', '--no-newline' ], [ 'wl-copy' ]),
+        ([ 'xclip', '-selection', 'clipboard', '-o' ], [ 'xclip', '-selection', 'clipboard' ]),
+        ([ 'xsel', '--clipboard', '--output' ], [ 'xsel', '--clipboard', '--input' ]),
+        ([ 'powershell', '-NoProfile', '-Command', 'Get-Clipboard -Raw' ],
+         [ 'powershell', '-NoProfile', '-Command', 'Set-Clipboard -Value ([Console]::In.ReadToEnd())' ]),
+    ]
+
+    def __init__(self):
+        import shutil
+        import subprocess
+        self._subprocess = subprocess
+        for get_command, set_command in self.COMMANDS:
+            if shutil.which(get_command[0]) is not None:
+                self._get_command = get_command
+                self._set_command = set_command
+                return
+        raise RuntimeError('No clipboard tool found (pbpaste, wl-paste, xclip, xsel or powershell)')
+
+    def get(self):
+        output = self._subprocess.run(self._get_command, stdout = self._subprocess.PIPE,
+                                      stderr = self._subprocess.DEVNULL).stdout
+        return output.decode('utf-8', 'replace')
+
+    def set(self, text):
+        self._subprocess.run(self._set_command, input = text.encode('utf-8'), stdout = self._subprocess.DEVNULL,
+                             stderr = self._subprocess.DEVNULL)
 
 
 def _clipboard(args):
-    result = Connector(args.url, args.user, args.password).clipboard(args.text)
+    if args.watch or args.sync:
+        local_clipboard = _LocalClipboard() if args.sync else None
+        if args.text is not None:
+            _connector(args).clipboard(args.text)
+        try:
+            for text in _connector(args).watch_clipboard(args.interval, max(args.interval, 5.0), local_clipboard):
+                print(text)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        return
+    result = _connector(args).clipboard(args.text)
     if result is not None:
         print(result)
 
 
+def _batch(args):
+    import threading
+    session = _Session(args, args.config)
+    name = '<stdin>' if args.file == '-' else args.file
+    lines = sys.stdin if args.file == '-' else open(args.file)
+    pending = deque()
+    failures = []
+
+    def fail(lineno, err):
+        message = '{}:{}: {}'.format(name, lineno, _error_message(err))
+        if not args.keep_going:
+            raise RuntimeError(message)
+        sys.stderr.write(message + '\n')
+        failures.append(lineno)
+
+    def finish():
+        lineno, thread, result = pending.popleft()
+        thread.join()
+        sys.stdout.flush()
+        sys.stdout.buffer.write(result['output'])
+        sys.stdout.buffer.flush()
+        if 'error' in result:
+            fail(lineno, result['error'])
+
+    def run_captured(command_args, result):
+        sys.stdout.capture()
+        try:
+            session.run(command_args)
+        except (URLError, OSError, RuntimeError) as err:
+            result['error'] = err
+        finally:
+            result['output'] = sys.stdout.release()
+
+    stdout = sys.stdout
+    if args.pipeline > 1:
+        sys.stdout = _ThreadOutput(stdout)
+    try:
+        for lineno, argv in _batch_commands(name, lines):
+            pipelined = args.pipeline > 1 and argv[0] in _Session.PIPELINED_COMMANDS
+            # Other commands may modify the device or the current directory: they wait for the previous ones
+            while pending and (not pipelined or len(pending) >= args.pipeline):
+                finish()
+            try:
+                if pipelined:
+                    command_args = session.parse(argv)
+                    if command_args is not None:
+                        result = {}
+                        thread = threading.Thread(target = run_captured, args = (command_args, result))
+                        thread.daemon = True
+                        thread.start()
+                        pending.append((lineno, thread, result))
+                else:
+                    session.execute(argv)
+            except (URLError, OSError, RuntimeError) as err:
+                fail(lineno, err)
+        while pending:
+            finish()
+    finally:
+        try:
+            while pending:
+                pending.popleft()[1].join()
+        finally:
+            sys.stdout = stdout
+            if lines is not sys.stdin:
+                lines.close()
+    if failures:
+        raise RuntimeError('{} commands failed'.format(len(failures)))
+
+
+def _shell(args):
+    import shlex
+    try:
+        # Line editing and history for input()
+        import readline
+    except ImportError:
+        pass
+    session = _Session(args, args.config)
+    while True:
+        try:
+            line = input('sweech:{}> '.format(session.cwd or '/'))
+        except KeyboardInterrupt:
+            print()
+            continue
+        except EOFError:
+            print()
+            break
+        try:
+            argv = shlex.split(line, comments = True)
+            if not argv:
+                continue
+            if argv[0] in ('exit', 'quit'):
+                break
+            if argv[0] == 'help':
+                session.print_help()
+                print('Shell commands: help, exit')
+                continue
+            session.execute(argv)
+        except (URLError, OSError, RuntimeError, ValueError) as err:
+            sys.stderr.write(_error_message(err) + '\n')
+        except KeyboardInterrupt:
+            print()
+
+
+class _CommandParser(argparse.ArgumentParser):
+    """Parser of a command whose arguments are only declared when this command is used"""
+
+    def __init__(self, arguments = None, **kwargs):
+        argparse.ArgumentParser.__init__(self, **kwargs)
+        self._arguments = arguments
+
+    def parse_known_args(self, args = None, namespace = None):
+        if self._arguments is not None:
+            self._arguments(self)
+            self._arguments = None
+        return argparse.ArgumentParser.parse_known_args(self, args, namespace)
+
+
+_COMMANDS = [
+    ('info', 'Prints information and default paths of your device', None),
+    ('ls', 'List the content of a folder or display details of a file', None),
+    ('du', 'Display the size of remote folders', None),
+    ('find', 'Search files and folders in remote folders', None),
+    ('pull', 'Pull files and folders from the remote device to a local folder',
+     """Pull files and folders from the remote device to a local folder.
+        If remote file path is relative, the `defaultdir` entry in
+        `settings.json` is used as base"""),
+    ('push', 'Pushes files or directories to a remote path.',
+     """Pushes files or directories to a remote path.
+        If no remote file is specified or a relative path is used,
+        the `defaultdir` entry in `settings.json` is used as base.
+        You can only create files and folders in the internal storage.
+        External storage (SD card) is writable too if you have granted
+        Sweech this authorisation in the app's settings."""),
+    ('sync', 'Synchronize a remote folder and a local folder',
+     """Synchronize a remote folder and a local folder.
+        Only files added or changed since the previous
+        synchronization are transferred. The state of the previous
+        run is stored in a `.sweech-sync.json` file in the local folder.
+        If remote path is relative, the `defaultdir` entry in
+        `settings.json` is used as base"""),
+    ('mkdir', 'Create remote folders', 'Create remote folders. Missing intermediate directories are created too'),
+    ('rm', 'Delete remote files and folders', None),
+    ('mv', 'Move remote files and folders', None),
+    ('cat', 'Displays the content of files', None),
+    ('clipboard', 'Get or set the clipboard content', None),
+    ('batch', 'Run the commands of a file with a single connection',
+     """Run the commands of a file, one per line, written like the command line arguments
+        of sweech (`ls DCIM`, `pull -j 4 DCIM/Camera photos`...). All commands share the
+        same connection to the device. `cd PATH` changes the base of relative remote
+        paths, initially the `defaultdir` entry in `settings.json`"""),
+    ('shell', 'Run commands interactively with a single connection',
+     """Run commands typed interactively, written like the command line arguments of sweech.
+        All commands share the same connection to the device. `cd PATH` changes the base of
+        relative remote paths, initially the `defaultdir` entry in `settings.json`"""),
+]
+
+
+def _add_commands(parser, commands):
+    subparsers = parser.add_subparsers(dest = 'command', title='Available commands', metavar = 'command',
+                                       parser_class = _CommandParser)
+    for name, help, description in commands:
+        subparsers.add_parser(name, help = help, description = description,
+                              arguments = getattr(sys.modules[__name__], '_{}_arguments'.format(name), None))
+
+
+def _ls_arguments(parser):
+    parser.add_argument('-R', '--recursive', action = 'store_true', help = 'List the content of subfolders too')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent listings with --recursive (default: 4)')
+    parser.add_argument('paths', nargs = '*', help = 'Paths to list')
+
+
+def _du_arguments(parser):
+    parser.add_argument('-s', '--summarize', action = 'store_true', help = 'Display only the total of each path')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent listings (default: 4)')
+    parser.add_argument('paths', nargs = '*', help = 'Folders to measure')
+
+
+def _find_arguments(parser):
+    parser.add_argument('--name', help = "Only display entries whose name matches this pattern (e.g. '*.jpg')")
+    parser.add_argument('--min-size', type = _parse_size, metavar = 'SIZE',
+                        help = 'Only display files of at least SIZE bytes, K, M and G suffixes are accepted')
+    parser.add_argument('--type', choices = [ 'f', 'd' ], help = 'Only display files (f) or folders (d)')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent listings (default: 4)')
+    parser.add_argument('paths', nargs = '*', help = 'Folders to search')
+
+
+def _pull_arguments(parser):
+    parser.add_argument('--keep', help = 'Preserve existing files', action = 'store_true')
+    parser.add_argument('--resume', help = 'Complete partially downloaded files', action = 'store_true')
+    parser.add_argument('--journal', action = 'store_true',
+                        help = 'Record the progress of folder transfers in a journal, to be able to --continue them')
+    parser.add_argument('--continue', dest = 'continue_journal', action = 'store_true',
+                        help = 'Continue an interrupted pull of the same paths from its journal')
+    parser.add_argument('--verify', help = 'Verify transferred files and record their SHA-256 checksums',
+                        action = 'store_const', const = 'sha256')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent transfers (default: 1)')
+    parser.add_argument('paths', nargs = '+', help = 'Remote paths to pull')
+    parser.add_argument('destination', nargs = '?', help = 'Local destination path')
+
+
+def _push_arguments(parser):
+    parser.add_argument('--keep', help = 'Preserve existing files', action = 'store_true')
+    parser.add_argument('--journal', action = 'store_true',
+                        help = 'Record the progress of folder transfers in a journal, to be able to --continue them')
+    parser.add_argument('--continue', dest = 'continue_journal', action = 'store_true',
+                        help = 'Continue an interrupted push of the same paths from its journal')
+    parser.add_argument('--verify', help = 'Verify transferred files and record their SHA-256 checksums',
+                        action = 'store_const', const = 'sha256')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent transfers (default: 1)')
+    parser.add_argument('paths', nargs = '+', help = 'Local paths to push')
+    parser.add_argument('destination', nargs = '?', help = 'Remote destination path')
+
+
+def _sync_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--pull', dest = 'direction', action = 'store_const', const = 'pull', default = 'pull',
+                       help = 'Update local files from the device (default)')
+    group.add_argument('--push', dest = 'direction', action = 'store_const', const = 'push',
+                       help = 'Update remote files from the local folder')
+    group.add_argument('--both', dest = 'direction', action = 'store_const', const = 'both',
+                       help = 'Propagate changes in both directions')
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent transfers (default: 1)')
+    parser.add_argument('path', nargs = '?', help = 'Remote folder')
+    parser.add_argument('destination', nargs = '?', default = '.', help = 'Local folder')
+
+
+def _mkdir_arguments(parser):
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent requests (default: 1)')
+    parser.add_argument('paths', nargs = '+', help = 'Folders to create')
+
+
+def _rm_arguments(parser):
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent requests (default: 1)')
+    parser.add_argument('paths', nargs = '+', help = 'Files and folders to delete')
+
+
+def _mv_arguments(parser):
+    parser.add_argument('-j', '--jobs', type = int, help = 'Number of concurrent requests (default: 1)')
+    parser.add_argument('paths', nargs = '+', help = 'Paths to move')
+    parser.add_argument('destination', nargs = '?', help = 'Destination path')
+
+
+def _cat_arguments(parser):
+    parser.add_argument('--offset', type = int, default = 0,
+                        help = 'Start at this byte offset, negative values are relative to the end of the file')
+    parser.add_argument('--bytes', type = int, help = 'Maximum number of bytes to display')
+    parser.add_argument('paths', nargs = '+', help = 'Files to display')
+
+
+def _clipboard_arguments(parser):
+    parser.add_argument('-w', '--watch', action = 'store_true',
+                        help = 'Print the clipboard content each time it changes, until interrupted')
+    parser.add_argument('-s', '--sync', action = 'store_true',
+                        help = 'Like --watch, and keep the clipboard of this computer in sync in both directions')
+    parser.add_argument('-i', '--interval', type = float, default = 0.5,
+                        help = 'Seconds between two polls after a change, the polls slow down to 5 seconds while '
+                               'the clipboard doesn\'t change (default: 0.5)')
+    parser.add_argument('text', nargs = '?', help = 'The text to put in the clipboard or omit to get the clipboard content')
+
+
+def _batch_arguments(parser):
+    parser.add_argument('-p', '--pipeline', type = int, default = 1,
+                        help = 'Number of consecutive read-only commands (info, ls, du, find, cat, pull) run concurrently '
+                               '(default: 1)')
+    parser.add_argument('-k', '--keep-going', action = 'store_true', help = 'Continue after a failed command')
+    parser.add_argument('file', help = 'File containing the commands, - to read them from the standard input')
+
+
 # == Main =====================================================================
 
 
 def _main():
     main_parser = argparse.ArgumentParser(description = 'Sweech command line')
-    main_parser.add_argument('-u', '--url', help = 'URL displayed in the Sweech app')
+    main_parser.add_argument('-u', '--url', action = 'append',
+                             help = 'URL displayed in the Sweech app, may be repeated to push or pull files '
+                                    'to or from several devices at once')
     main_parser.add_argument('--user', help = 'Username if a password has been set')
     main_parser.add_argument('--password', help = 'Password if a password has been set')
-
-    subparsers = main_parser.add_subparsers(dest = 'command', title='Available commands', metavar = 'command')
-
-    subparsers.add_parser('info', help = 'Prints information and default paths of your device')
-
-    subparser = subparsers.add_parser('ls', help = 'List the content of a folder or display details of a file')
-    subparser.add_argument('paths', nargs = '*', help = 'Paths to list')
-
-    subparser = subparsers.add_parser('pull', help = 'Pull files and folders from the remote device to a local folder',
-                                              description="""Pull files and folders from the remote device to a local folder.
-                                                             If remote file path is relative, the `defaultdir` entry in
-                                                             `settings.json` is used as base""")
-    subparser.add_argument('--keep', help = 'Preserve existing files', action = 'store_true')
-    subparser.add_argument('paths', nargs = '+', help = 'Remote paths to pull')
-    subparser.add_argument('destination', nargs = '?', help = 'Local destination path')
-
-    subparser = subparsers.add_parser('push', help = "Pushes files or directories to a remote path.",
-                                              description="""Pushes files or directories to a remote path.
-                                                             If no remote file is specified or a relative path is used,
-                                                             the `defaultdir` entry in `settings.json` is used as base.
-                                                             You can only create files and folders in the internal storage.
-                                                             External storage (SD card) is writable too if you have granted
-                                                             Sweech this authorisation in the app's settings.""")    
-    subparser.add_argument('--keep', help = 'Preserve existing files', action = 'store_true')
-    subparser.add_argument('paths', nargs = '+', help = 'Local paths to push')
-    subparser.add_argument('destination', nargs = '?', help = 'Remote destination path')
-
-    subparser = subparsers.add_parser('mkdir', help = 'Create remote folders',
-                                               description="Create remote folders. Missing intermediate directories are created too")
-    subparser.add_argument('paths', nargs = '+', help = 'Folders to create')
-
-    subparser = subparsers.add_parser('rm', help = 'Delete remote files and folders')
-    subparser.add_argument('paths', nargs = '+', help = 'Files and folders to delete')
-
-    subparser = subparsers.add_parser('mv', help = 'Move remote files and folders')
-    subparser.add_argument('paths', nargs = '+', help = 'Paths to move')
-    subparser.add_argument('destination', nargs = '?', help = 'Destination path')
-
-    subparser = subparsers.add_parser('cat', help = 'Displays the content of files')
-    subparser.add_argument('paths', nargs = '+', help = 'Files to display')
-
-    subparser = subparsers.add_parser('clipboard', help = 'Get or set the clipboard content')
-    subparser.add_argument('text', nargs = '?', help = 'The text to put in the clipboard or omit to get the clipboard content')
+    main_parser.add_argument('--stats', action = 'store_true', help = 'Print transfer statistics when done')
+    main_parser.add_argument('--trace', metavar = 'FILE', help = 'Write a Chrome trace of requests and transfers to FILE')
+    main_parser.add_argument('--cache-ttl', type = float, metavar = 'SECONDS',
+                             help = 'Cache remote folder listings between runs for this number of seconds')
+    main_parser.add_argument('--content-cache', action = 'store_true', default = None,
+                             help = 'Cache the content of the files read by cat and pull between runs')
+    main_parser.add_argument('--no-cache', action = 'store_true',
+                             help = 'Don\'t use the local caches of file contents and folder listings')
+    main_parser.add_argument('--limit-rate', type = _parse_size, metavar = 'RATE',
+                             help = 'Maximum transfer rate in bytes per second, with optional K, M or G suffix')
+    main_parser.add_argument('--adaptive', action = 'store_true', default = None,
+                             help = 'Tune the chunk size and the number of concurrent transfers from the throughput')
+
+    _add_commands(main_parser, _COMMANDS)
 
     args = main_parser.parse_args()
 
@@ -465,30 +3842,26 @@ def _main():
         main_parser.print_help()
         sys.exit(1)
 
-    config = {}
-    if sys.platform == 'win32':
-        config_path = os.path.join(os.getenv('APPDATA'), 'sweech.json')
-    else:
-        config_path = os.path.join(os.getenv('HOME'), '.config', 'sweech.json')
-    if os.path.exists(config_path):
-        config = json.loads(open(config_path).read())
-    for key in config.keys():
-        if not hasattr(args, key) or getattr(args, key) is None:
-            setattr(args, key, config[key])
+    args.config = _load_config()
+    _apply_config(args, args.config)
 
     try:
         handler = getattr(sys.modules[__name__], '_' + args.command)
         if handler:
-            handler(args)
+            if args.trace:
+                args.trace_writer = _TraceWriter(args.trace)
+            try:
+                handler(args)
+            finally:
+                if hasattr(args, 'connector'):
+                    args.connector.close()
+                    if args.stats:
+                        _print_stats(args.connector.stats())
+                if args.trace:
+                    args.trace_writer.close()
         sys.exit(0)
-    except URLError as err:
-        sys.stderr.write(str(err.reason) + '\n')
-        sys.exit(2)
-    except OSError as err:
-        sys.stderr.write(str(err) + '\n')
-        sys.exit(2)
-    except RuntimeError as err:
-        sys.stderr.write(str(err.args[0]) + '\n')
+    except (URLError, OSError, RuntimeError) as err:
+        sys.stderr.write(_error_message(err) + '\n')
         sys.exit(2)
     except KeyboardInterrupt:
         sys.exit(3)
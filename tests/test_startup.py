@@ -0,0 +1,56 @@
+"""Checks that the `sweech` command line starts fast.
+
+Each check runs in a new interpreter, the way the installed `sweech` script starts:
+
+    $ python -m unittest discover tests
+"""
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which take several milliseconds to import and are only needed by some commands
+_SLOW_MODULES = [ 'asyncio', 'http.client', 'queue', 'shlex', 'socket', 'ssl', 'threading', 'urllib.request' ]
+
+# Maximum time in seconds `sweech --help` may add to the interpreter startup. The first version of the
+# command line, which imported everything at startup, added about 42 ms.
+_HELP_TARGET = 0.035
+
+
+def _run(*args):
+    env = dict(os.environ, PYTHONPATH = _ROOT)
+    return subprocess.check_output([ sys.executable ] + list(args), env = env, cwd = _ROOT,
+                                   stderr = subprocess.DEVNULL).decode('utf-8')
+
+
+def _best_time(*args):
+    best = None
+    for _ in range(10):
+        start = time.perf_counter()
+        _run(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_slow_modules_not_imported(self):
+        output = _run('-c', 'import sys, sweech; print(" ".join(sorted(sys.modules)))')
+        imported = [ module for module in _SLOW_MODULES if module in output.split() ]
+        self.assertEqual(imported, [], 'imported by `import sweech`')
+
+    def test_help_startup_time(self):
+        # Compiles sweech.py first, a stale bytecode cache would be timed otherwise
+        _run('-m', 'py_compile', 'sweech.py')
+        interpreter = _best_time('-c', 'pass')
+        overhead = _best_time('-c', 'import sweech; sweech._main()', '--help') - interpreter
+        self.assertLess(overhead, _HELP_TARGET)
+
+
+if __name__ == '__main__':
+    unittest.main()